@@ -9,12 +9,15 @@ Copyright 2013 (c) Berker Peksag
 
 """
 
-from .code_gen import SourceGenerator, to_source  # NOQA
+from .code_gen import SourceGenerator, to_source, iter_source  # NOQA
+from .code_gen import expr_to_source, ato_source  # NOQA
+from .code_gen import dump_source, to_source_many, VerificationError  # NOQA
 from .node_util import iter_node, strip_tree, dump_tree  # NOQA
 from .node_util import ExplicitNodeVisitor  # NOQA
 from .file_util import CodeToAst, code_to_ast  # NOQA
 from .op_util import get_op_symbol, get_op_precedence  # NOQA
 from .op_util import symbol_data  # NOQA
+from .source_map import SourceMap  # NOQA
 from .tree_walk import TreeWalk  # NOQA
 
 __version__ = '0.8.1'
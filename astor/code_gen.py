@@ -17,19 +17,36 @@ this code came from here (in 2012):
 
 """
 
+import array
 import ast
+import collections
+import concurrent.futures
+import functools
 import inspect
+import io
 import math
+import operator
+import os
+import re
 import sys
+import threading
+import time
+import warnings
 
 from .op_util import get_op_symbol, get_op_precedence, Precedence
-from .node_util import ExplicitNodeVisitor
-from .source_repr import pretty_source
+from .op_util import symbol_data
+from .node_util import ExplicitNodeVisitor, fast_compare
+from .file_util import code_to_ast
+from .source_repr import pretty_source, WrapCache
+from .source_repr import (Opening, Closing, Separator, Assignment,
+                          Statement)
+from .source_map import SourceMap
 
 
 def to_source(node, indent_with=' ' * 4, add_line_information=False,
               pretty_source=pretty_source,
-              source_generator_class=None):
+              source_generator_class=None, verify=False, threads=1,
+              **options):
     """This function can convert a node tree back into python sourcecode.
     This is useful for debugging purposes, especially if you're dealing with
     custom asts not generated by python itself.
@@ -49,27 +66,413 @@ def to_source(node, indent_with=' ' * 4, add_line_information=False,
 
     `source_generator_class` defaults to `SourceGenerator`, and specifies the
     class that will be instantiated and used to generate the source code.
+    Any other keyword arguments are passed on to it; see `SourceGenerator`
+    for the options it accepts.
 
+    If the `source_map` option is set, a (source, source_map) tuple is
+    returned, where source_map is a `SourceMap` of the generated code.
+
+    If the `profile` option is set to a dict, statistics about the time
+    spent generating the source are added to it; see `SourceGenerator`.
+
+    If `verify` is true, the source is parsed again and compared with
+    the tree, raising `VerificationError` if it does not match.  Each
+    top-level statement of a module is checked as soon as it has been
+    written, so generation stops at the first one that does not match.
+
+    If `threads` is greater than 1, the top-level statements of a module
+    are split into runs that are converted on that many threads, each
+    with a generator of its own.  The result is the same as with a
+    single thread.  This only makes conversion faster on free-threaded
+    builds of Python.  The `source_map` and `profile` options cannot be
+    combined with it.
+
+    """
+    if threads > 1 and isinstance(node, ast.Module) and len(node.body) > 1:
+        if options.get('source_map') or options.get('profile') is not None:
+            raise ValueError('source_map and profile cannot be combined '
+                             'with threads')
+        return _threaded_source(node, threads, indent_with,
+                                add_line_information, pretty_source,
+                                source_generator_class, verify, options)
+    if verify and isinstance(node, (ast.Module, ast.Interactive)):
+        if options.get('source_map'):
+            raise ValueError('source_map cannot be combined with verify')
+        return ''.join(iter_source(node, indent_with, add_line_information,
+                                   pretty_source, source_generator_class,
+                                   verify=True, **options))
+    generator = _get_generator(source_generator_class, indent_with,
+                               add_line_information, options)
+    given_pretty_source = pretty_source
+    pretty_source = _pretty_source(pretty_source, generator)
+    if verify and generator.strip_docstrings:
+        raise ValueError('strip_docstrings cannot be combined with verify')
+    generator.visit(node)
+    generator.result.append('\n')
+    if set(generator.result[0]) == set('\n'):
+        generator.result[0] = ''
+    source = pretty_source(generator.result)
+    if verify:
+        _verify_source(node, source)
+    if options.get('source_map'):
+        try:
+            source_map = SourceMap.from_fragments(generator.result,
+                                                  generator.spans, source)
+        except ValueError as exc:
+            raise ValueError('source_map cannot be built, because '
+                             'pretty_source %r changed the text of the '
+                             'generated code (%s); it may only add '
+                             'linefeeds, indentation and parentheses' %
+                             (given_pretty_source, exc)) from exc
+        return source, source_map
+    return source
+
+
+def _threaded_source(node, threads, indent_with, add_line_information,
+                     pretty_source, source_generator_class, verify, options):
+    """Convert a module on `threads` threads for `to_source`.
+
+    The body is split into runs of consecutive statements, and each run
+    is written and wrapped by a generator of its own, as if it started
+    the module.  The only state that carries over from one top-level
+    statement to the next is the number of linefeeds waiting to be
+    written (for instance, the blank lines after a function), so when
+    the pieces are joined the linefeeds in front of each run are
+    recomputed the way `newline` would have merged them.
+    """
+    body = node.body
+    count = min(len(body), threads * 4)
+    bounds = [len(body) * index // count for index in range(count + 1)]
+    generators = [_get_generator(source_generator_class, indent_with,
+                                 add_line_information, options)
+                  for index in range(count)]
+    pretty_source = _pretty_source(pretty_source, generators[0])
+    if verify and generators[0].strip_docstrings:
+        raise ValueError('strip_docstrings cannot be combined with verify')
+
+    def convert(index):
+        generator = generators[index]
+        statements = body[bounds[index]:bounds[index + 1]]
+        if index:
+            for statement in statements:
+                generator.visit(statement)
+        else:
+            # Write the module docstring, if there is one
+            module = ast.Module(body=statements, type_ignores=[])
+            for statement in generator.iter_statements(module):
+                pass
+        result = generator.result
+        linefeeds = 0
+        if result and set(result[0]) == set('\n'):
+            linefeeds = len(result[0])
+            result[0] = ''
+        result.append('\n')
+        source = pretty_source(result)
+        if verify:
+            _verify_source(statements, source)
+        generators[index] = None
+        return linefeeds, source[:-1], generator.new_lines
+
+    pieces = []
+    waiting = 0
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        for linefeeds, source, new_lines in pool.map(convert, range(count)):
+            if not source:
+                waiting = max(waiting, new_lines)
+                continue
+            if pieces:
+                pieces.append('\n' * max(waiting, linefeeds))
+            pieces.append(source)
+            waiting = new_lines
+    pieces.append('\n')
+    return ''.join(pieces)
+
+
+def expr_to_source(node, source_generator_class=None,
+                   _local=threading.local()):
+    """Convert a small node, usually an expression, to source code
+    with as little overhead as possible.
+
+    Each thread keeps a generator of each `source_generator_class`
+    (by default, `SourceGenerator`) and resets it for every call,
+    rather than creating a new one.  The result is the same as that
+    of `to_source` with the default options, without the trailing
+    linefeed; lines longer than 79 characters are still wrapped.
+
+    """
+    try:
+        generators = _local.generators
+    except AttributeError:
+        generators = _local.generators = {}
+    # The generator is taken out while in use, in case a subclass
+    # calls this again from one of its visit methods.
+    generator = generators.pop(source_generator_class, None)
+    if generator is None:
+        generator = _get_generator(source_generator_class, ' ' * 4,
+                                   False, {})
+    generator.visit(node)
+    result = generator.result
+    if result and result[0][:1] == '\n':
+        result[0] = ''
+    source = ''.join(result)
+    if len(source) > 79:
+        result.append('\n')
+        source = pretty_source(result)[:-1]
+    generator.reset()
+    generators[source_generator_class] = generator
+    return source
+
+
+def iter_source(node, indent_with=' ' * 4, add_line_information=False,
+                pretty_source=pretty_source,
+                source_generator_class=None, chunksize=1, verify=False,
+                **options):
+    """Like `to_source`, but yields the source code in pieces.
+
+    For a module, each yielded string contains the complete, wrapped
+    source of `chunksize` top-level statements.  Fragments are released
+    as soon as they have been yielded, so memory use is bounded by the
+    largest chunk rather than by the size of the whole module.  Other
+    nodes are yielded in a single piece.
+
+    Joining the pieces gives the same result as `to_source`, as long as
+    `pretty_source` only looks at one line at a time (like the default).
+    The `source_map` option is not supported.
+
+    If `verify` is true, each piece is checked against the statements
+    it was generated from before it is yielded, as in `to_source`.
+
+    """
+    if options.get('source_map'):
+        raise ValueError('source_map is only supported by to_source()')
+    generator = _get_generator(source_generator_class, indent_with,
+                               add_line_information, options)
+    pretty_source = _pretty_source(pretty_source, generator)
+    if verify and generator.strip_docstrings:
+        raise ValueError('strip_docstrings cannot be combined with verify')
+    result = generator.result
+    first = True
+    if isinstance(node, (ast.Module, ast.Interactive)):
+        pending = []
+        mark = 0
+        for statement in generator.iter_statements(node):
+            # result[mark:] holds the statement that was just written.
+            # It starts with the linefeeds that terminate the statements
+            # before it, so everything up to there can be wrapped now.
+            if (len(pending) >= chunksize and len(result) > mark and
+                    result[mark].startswith('\n')):
+                if first:
+                    first = False
+                    if set(result[0]) == set('\n'):
+                        result[0] = ''
+                source = pretty_source(result.split(mark + 1))
+                if verify:
+                    _verify_source(pending, source)
+                yield source
+                pending = []
+            pending.append(statement)
+            mark = len(result)
+    else:
+        pending = node
+        generator.visit(node)
+    result.append('\n')
+    if first and set(result[0]) == set('\n'):
+        result[0] = ''
+    source = pretty_source(result)
+    if verify:
+        _verify_source(pending, source)
+    yield source
+
+
+def dump_source(node, file, indent_with=' ' * 4, add_line_information=False,
+                pretty_source=pretty_source,
+                source_generator_class=None, encoding='utf-8',
+                buffersize=1 << 16, **options):
+    """Write the source code for a node tree to `file`.
+
+    If `file` is a text file (an instance of io.TextIOBase), the
+    source is written to it as it is; anything else is taken to be a
+    binary file, and the source is encoded using `encoding`.
+
+    The source is produced by `iter_source` and written whenever at
+    least `buffersize` characters are ready, so the complete source
+    never has to exist in memory as a single string or bytes object.
+
+    The remaining parameters are the same as for `to_source`.
+
+    """
+    binary = not isinstance(file, io.TextIOBase)
+    write = file.write
+    pieces = []
+    size = 0
+    for piece in iter_source(node, indent_with, add_line_information,
+                             pretty_source, source_generator_class,
+                             **options):
+        pieces.append(piece)
+        size += len(piece)
+        if size >= buffersize:
+            text = ''.join(pieces)
+            write(text.encode(encoding) if binary else text)
+            del pieces[:]
+            size = 0
+    if pieces:
+        text = ''.join(pieces)
+        write(text.encode(encoding) if binary else text)
+
+
+async def ato_source(node, indent_with=' ' * 4, add_line_information=False,
+                     pretty_source=pretty_source,
+                     source_generator_class=None, interval=0.005,
+                     **options):
+    """Like `to_source`, but a coroutine that lets the asyncio event
+    loop run other tasks while a large module is converted.
+
+    The source is produced by `iter_source`, and whenever `interval`
+    seconds have passed since the loop last had control, it is given
+    control again before the next top-level statement is converted.
+    A single statement is always converted without a break, so the
+    loop may still be blocked by one very large class or function;
+    `loop.run_in_executor` avoids that at the cost of a thread.
+
+    The remaining parameters are the same as for `iter_source`.
+
+    """
+    import asyncio  # Only needed here, and slow to import
+    sleep = asyncio.sleep
+    timer = time.perf_counter
+    pieces = []
+    deadline = timer() + interval
+    for piece in iter_source(node, indent_with, add_line_information,
+                             pretty_source, source_generator_class,
+                             **options):
+        pieces.append(piece)
+        if timer() >= deadline:
+            await sleep(0)
+            deadline = timer() + interval
+    return ''.join(pieces)
+
+
+def to_source_many(items, workers=None, ordered=True, chunksize=1,
+                   executor=None, **kwargs):
+    """Convert many node trees or Python files to source code,
+    using a pool of worker processes.
+
+    Each item may be a node tree, or the path of a Python file.  Files
+    are parsed by the worker process itself, so only the path and the
+    generated source cross the process boundary.  Node trees have to
+    be pickled to be sent to the worker.
+
+    `workers` is the number of processes to start (by default, one per
+    CPU).  Alternatively, an existing `concurrent.futures` executor may
+    be passed as `executor`, so that warm workers can be reused between
+    calls; it is not shut down afterwards.  `chunksize` is the number of
+    items sent to a worker at a time.  Any other keyword arguments are
+    passed to `to_source`, and must be picklable.
+
+    This returns an iterator.  If `ordered` is true, it yields the
+    source for each item in input order.  Otherwise, it yields
+    (index, source) pairs in the order the results are completed.
+
+    """
+    convert = functools.partial(_to_source_item, kwargs)
+    pool = executor
+    if pool is None:
+        pool = concurrent.futures.ProcessPoolExecutor(workers)
+    try:
+        if ordered:
+            for source in pool.map(convert, items, chunksize=chunksize):
+                yield source
+        else:
+            futures = dict((pool.submit(convert, item), index)
+                           for index, item in enumerate(items))
+            for future in concurrent.futures.as_completed(futures):
+                yield futures[future], future.result()
+    finally:
+        if executor is None:
+            pool.shutdown(cancel_futures=True)
+
+
+def _to_source_item(kwargs, item):
+    if not isinstance(item, ast.AST):
+        item = code_to_ast.parse_file(os.fspath(item))
+    return to_source(item, **kwargs)
+
+
+class VerificationError(ValueError):
+    """Raised by `to_source` and `iter_source` when the source that
+    was generated for a node does not parse back to the same tree.
+
+    The `node` attribute is the offending top-level statement (or the
+    node that was converted), and `source` is the source generated
+    for it.
     """
+
+    def __init__(self, message, node, source):
+        ValueError.__init__(self, message)
+        self.node = node
+        self.source = source
+
+
+def _verify_source(node, source, ignore=('ctx', 'type_comment')):
+    """Check that `source` parses back to `node`, which may also be a
+    list of top-level statements.  Nodes other than statements and
+    expressions are not checked.
+    """
+    if isinstance(node, ast.AST):
+        if isinstance(node, (ast.expr, ast.Expression)):
+            mode = 'eval'
+        elif isinstance(node, ast.stmt):
+            mode = 'exec'
+            node = [node]
+        else:
+            return
+    else:
+        mode = 'exec'
+    try:
+        tree = ast.parse(source, mode=mode)
+    except SyntaxError as exc:
+        message = 'generated source is not valid Python: %s' % exc
+        tree = []
+    else:
+        if mode == 'exec' or isinstance(node, ast.expr):
+            tree = tree.body
+        if fast_compare(node, tree, ignore):
+            return
+        message = 'generated source does not parse back to the tree'
+    if isinstance(node, list):
+        # Find the first statement of the piece that did not match
+        for statement, parsed in zip(node, tree):
+            if not fast_compare(statement, parsed, ignore):
+                break
+        else:
+            statement = node[len(tree)] if len(tree) < len(node) else node[0]
+        node = statement
+    raise VerificationError(message, node, source)
+
+
+def _get_generator(source_generator_class, indent_with,
+                   add_line_information, options):
     if source_generator_class is None:
         source_generator_class = SourceGenerator
     elif not inspect.isclass(source_generator_class):
         raise TypeError('source_generator_class should be a class')
     elif not issubclass(source_generator_class, SourceGenerator):
         raise TypeError('source_generator_class should be a subclass of SourceGenerator')
-    generator = source_generator_class(indent_with, add_line_information)
-    generator.visit(node)
-    generator.result.append('\n')
-    if set(generator.result[0]) == set('\n'):
-        generator.result[0] = ''
-    return pretty_source(generator.result)
+    return source_generator_class(indent_with, add_line_information,
+                                  **options)
 
 
-def precedence_setter(AST=ast.AST, get_op_precedence=get_op_precedence,
+def precedence_setter(precedence, AST=ast.AST, id=id,
+                      get_op_precedence=get_op_precedence,
                       isinstance=isinstance, list=list):
     """ This only uses a closure for performance reasons,
         to reduce the number of attribute lookups.  (set_precedence
         is called a lot of times.)
+
+        The precedence of each node's parent is stored in the
+        `precedence` dict, keyed by the id() of the node, rather
+        than on the node itself, so that generating source never
+        modifies the tree it is given.
     """
 
     def set_precedence(value, *nodes):
@@ -79,7 +482,7 @@ def precedence_setter(AST=ast.AST, get_op_precedence=get_op_precedence,
             value = get_op_precedence(value)
         for node in nodes:
             if isinstance(node, AST):
-                node._pp = value
+                precedence[id(node)] = value
             elif isinstance(node, list):
                 set_precedence(value, *node)
             else:
@@ -88,7 +491,268 @@ def precedence_setter(AST=ast.AST, get_op_precedence=get_op_precedence,
     return set_precedence
 
 
-set_precedence = precedence_setter()
+def set_precedence(value, *nodes):
+    """Set the precedence (of the parent) into the `_pp` attribute
+    of the children.
+
+    Deprecated: SourceGenerator keeps the precedences in a table of
+    its own, and only reads `_pp` from nodes that are not in it.
+    Subclasses should call the set_precedence() method of the
+    generator instead.  This function will be removed in the next
+    release.
+    """
+    warnings.warn('astor.code_gen.set_precedence() is deprecated; use '
+                  'the set_precedence() method of SourceGenerator',
+                  DeprecationWarning, stacklevel=2)
+    if isinstance(value, ast.AST):
+        value = get_op_precedence(value)
+    work = list(nodes)
+    while work:
+        node = work.pop()
+        if isinstance(node, ast.AST):
+            node._pp = value
+        elif isinstance(node, list):
+            work.extend(node)
+        else:
+            assert node is None, node
+
+
+# Padded fragments that compact mode writes without spaces
+_compact_fragments = {' = ': '=', ', ': ',', ': ': ':', ' -> ': '->',
+                      ' := ': ':=', ' | ': '|'}
+for _op, _symbol in symbol_data.items():
+    if isinstance(_op, type) and issubclass(_op, (ast.operator, ast.cmpop)) \
+            and not _symbol.replace(' ', '').isalpha():
+        _compact_fragments[' %s ' % _symbol] = _symbol
+        if issubclass(_op, ast.operator):
+            _compact_fragments[' %s= ' % _symbol] = _symbol + '='
+del _op, _symbol
+
+# The fragments that tell the line wrappers in source_repr
+# where a line may be broken, or parentheses added.
+_lparen, _lbracket, _lbrace = map(Opening, '([{')
+_rparen, _rbracket, _rbrace = map(Closing, ')]}')
+_rparen_colon = Closing('):')
+_comma = Separator(', ')
+_assign = Assignment(' = ')
+_augassign = dict((_op, Assignment(' %s= ' % _symbol))
+                  for _op, _symbol in symbol_data.items()
+                  if isinstance(_op, type) and issubclass(_op, ast.operator))
+_if, _while, _del, _return = map(Statement, ['if ', 'while ', 'del ',
+                                             'return'])
+
+
+def _profile_entry(stats, key):
+    entry = stats.get(key)
+    if entry is None:
+        entry = stats[key] = dict(calls=0, time=0.0, cumtime=0.0, chars=0)
+    return entry
+
+
+def _pretty_source(pretty_source, generator,
+                   default_pretty_source=pretty_source):
+    """Return the function that joins and wraps the fragments of one
+    conversion by `generator`, which may be called for several pieces.
+
+    The default `pretty_source` is given a `WrapCache` that is shared
+    by all the pieces of the conversion, and dropped with it.
+    """
+    wrap = None
+    if generator.compact:
+        pretty_source = _compact_source
+    elif pretty_source is default_pretty_source:
+        wrap = WrapCache()
+        pretty_source = functools.partial(pretty_source, wrap=wrap)
+    if generator.profile is not None:
+        pretty_source = _profiled(pretty_source, generator.profile, wrap)
+    return pretty_source
+
+
+def _profiled(pretty_source, stats, wrap=None, timer=time.perf_counter):
+    """Wrap `pretty_source` to record its statistics in `stats`,
+    including the hits and misses of its `WrapCache`, `wrap`.
+    """
+    entry = _profile_entry(stats, 'pretty_source')
+    if wrap is not None:
+        entry.setdefault('wrap_hits', 0)
+        entry.setdefault('wrap_misses', 0)
+    counted = [0, 0]
+
+    def profiled_pretty_source(fragments):
+        start = timer()
+        source = pretty_source(fragments)
+        elapsed = timer() - start
+        entry['calls'] += 1
+        entry['time'] += elapsed
+        entry['cumtime'] += elapsed
+        entry['chars'] += len(source)
+        if wrap is not None:
+            hits, misses = wrap.cache_info()[:2]
+            entry['wrap_hits'] += hits - counted[0]
+            entry['wrap_misses'] += misses - counted[1]
+            counted[:] = hits, misses
+        return source
+
+    return profiled_pretty_source
+
+
+def _interleave(*columns):
+    """Return the fragments for a sequence of items, where `columns`
+    alternates between the list of fragments written before each item
+    and the list of the items' sources, and the first fragment (the
+    separator in front of the first item) is left out.
+    """
+    pattern = []
+    slots = []
+    for before, sources in zip(columns[::2], columns[1::2]):
+        pattern.extend(before)
+        slots.append((len(pattern), sources))
+        pattern.append(None)
+    width = len(pattern)
+    fragments = pattern * len(slots[0][1])
+    for index, sources in slots:
+        fragments[index::width] = sources
+    del fragments[0]
+    return fragments
+
+
+def _compact_source(fragments):
+    """Join fragments written in compact mode, removing the padding
+       around operators and punctuation.  The fragments are replaced
+       in place, so that they still match the result.
+    """
+    get = _compact_fragments.get
+    fragments[:] = [get(fragment, fragment) for fragment in fragments]
+    return ''.join(fragments)
+
+
+def _escapes(escapes, hexchars):
+    """Return a function that replaces the characters in the `escapes`
+       dict with their escape sequences, and the characters in
+       `hexchars` with \\x or \\u escapes.
+
+       Escapes are rare, so the string is scanned by a regular
+       expression, and only calls back into Python for each character
+       that has to be escaped.  (str.translate is much slower for this,
+       as it cannot use its fast path when it maps characters to
+       several characters.)
+    """
+    escapes = dict(escapes)
+    for char in hexchars:
+        code = ord(char)
+        escapes.setdefault(char, ('\\x%02x' if code < 256 else '\\u%04x') % code)
+    pattern = re.compile('[%s]' % re.escape(''.join(escapes)))
+
+    def escape(value, search=pattern.search, sub=pattern.sub):
+        if search(value):
+            value = sub(lambda match: escapes[match.group()], value)
+        return value
+
+    return escape
+
+
+# Control characters other than linefeeds and tabs, and surrogates,
+# are written as \\x or \\u escapes.
+_hexchars = [chr(code) for code in range(32) if chr(code) not in '\n\t']
+_hexchars += [chr(code) for code in range(0xD800, 0xE000)]
+
+# Docstrings keep their linefeeds and tabs.  Backslashes are escaped
+# separately, as they are common and cheap to replace.
+_escape_docstring = _escapes({
+    '\0': '\\0', '\a': '\\a', '\b': '\\b', '\f': '\\f', '\r': '\\r',
+    '\v': '\\v',
+}, _hexchars)
+
+# The literal parts of f-strings are written on a single line, so
+# linefeeds and tabs are common too, and also replaced separately.
+_escape_fstring = _escapes({
+    '\0': '\\0', '\a': '\\a', '\b': '\\b', '\f': '\\f', '\r': '\\r',
+    '\v': '\\v',
+}, _hexchars + ['\x7f'])
+
+
+def _docstring_literal(value):
+    """Return a triple-quoted literal for a docstring."""
+    content = _escape_docstring(value.replace('\\', '\\\\'))
+    # Choose quote style to avoid issues with trailing quotes
+    if content.endswith('"'):
+        if "'''" not in content:
+            return "'''" + content + "'''"
+        # Content has ''' and ends with " — escape the trailing "
+        content = content[:-1] + '\\"'
+    return '"""' + content + '"""'
+
+
+def _fstring_literal(value):
+    """Escape the literal part of an f-string."""
+    value = value.replace('\\', '\\\\').replace('{', '{{').replace('}', '}}')
+    value = value.replace('\n', '\\n').replace('\t', '\\t')
+    return _escape_fstring(value)
+
+
+class _Repeated(dict):
+    """Maps a count to `text` repeated that many times, creating
+    each string only once.
+    """
+
+    def __init__(self, text):
+        dict.__init__(self)
+        self.text = text
+
+    def __missing__(self, count):
+        value = self[count] = self.text * count
+        return value
+
+
+class SourceBuffer(list):
+    """The list of fragments that `SourceGenerator` writes to.
+
+    It is an ordinary list of strings, except that the linefeeds and
+    indentation that start each line are taken from the `linefeeds`
+    and `indents` tables, so they are shared rather than created anew
+    for every line.
+
+    The generator also keeps the index of the first fragment of the
+    current line in `line_start`, and adds up the width of each line
+    as its fragments are written with `write` or `write_fragments`
+    (fragments appended to the buffer directly are not counted).
+    The lines that are longer than `maxline` characters,
+    and so may need wrapping, are listed in `long_lines` as (start,
+    end) pairs of indices, where end is the index of the linefeed
+    that ends the line.  `pretty_source` only has to look at those
+    lines and at the last one, which has not been measured yet.
+    """
+
+    maxline = 79
+
+    def __init__(self, indent_with, fragments=()):
+        list.__init__(self, fragments)
+        self.linefeeds = _Repeated('\n')
+        self.indents = _Repeated(indent_with)
+        self.line_start = 0
+        self.long_lines = []
+
+    def clear(self):
+        del self[:]
+        del self.long_lines[:]
+        self.line_start = 0
+
+    def split(self, count):
+        """Remove the first `count` fragments, which must end with a
+        linefeed, and return them as a new buffer with their lines.
+        """
+        head = SourceBuffer(self.indents.text, self[:count])
+        del self[:count]
+        long_lines = self.long_lines
+        index = 0
+        while index < len(long_lines) and long_lines[index][1] < count:
+            index += 1
+        head.long_lines = long_lines[:index]
+        head.line_start = count
+        long_lines[:] = [(start - count, end - count)
+                         for start, end in long_lines[index:]]
+        self.line_start -= count
+        return head
 
 
 class Delimit(object):
@@ -106,7 +770,7 @@ class Delimit(object):
             for initial data, because it may flush
             preceding data into result.
         """
-        delimiters = '()'
+        delimiters = _lparen, _rparen
         node = None
         op = None
         for arg in args:
@@ -118,6 +782,7 @@ class Delimit(object):
             else:
                 delimiters = arg
         tree.write(delimiters[0])
+        self.write_fragments = tree.write_fragments
         result = self.result = tree.result
         self.index = len(result)
         self.closing = delimiters[1]
@@ -135,7 +800,7 @@ class Delimit(object):
         if self.discard:
             result[start] = ''
         else:
-            result.append(self.closing)
+            self.write_fragments([self.closing])
 
 
 class SourceGenerator(ExplicitNodeVisitor):
@@ -145,30 +810,126 @@ class SourceGenerator(ExplicitNodeVisitor):
     For more details have a look at the docstring of the `to_source`
     function.
 
+    If `subtree_cache_size` is set, the output of expressions whose
+    node objects occur more than once in the tree is cached, up to
+    that many fragments in all, so that later occurrences are written
+    by copying it.
+
+    If `original_source` is given, it must be the text the tree was
+    parsed from.  Statements that are unchanged since then are written
+    by copying their original text.
+
+    If `source_map` is set, the span of fragments written for each
+    visited node is recorded in `spans`, so that `to_source` can return
+    a `SourceMap`.
+
+    If `compact` is set, no blank lines are written, and `to_source`
+    removes the spaces around operators and punctuation instead of
+    wrapping long lines.  If `strip_docstrings` is set, docstrings are
+    left out.
+
+    If `profile` is a dict, an entry is added to it (or updated) for
+    each visit method that is called, such as ``'visit_Name'``, and
+    `to_source` adds one for ``'pretty_source'``.  Each entry is a dict
+    with the number of `calls`, the `time` spent in the method itself
+    and the cumulative time `cumtime` including the nodes it visited
+    (both in seconds), and the number of `chars` it wrote itself.
+    The ``'pretty_source'`` entry also counts the `wrap_hits` and
+    `wrap_misses` of the `WrapCache` used by the default pretty_source.
+
+    Up to `literal_cache_size` string literals of each kind are cached.
+
     """
 
-    def __init__(self, indent_with, add_line_information=False,
+    literal_cache_size = 1024
+
+    def __init__(self, indent_with, add_line_information=False, *,
+                 subtree_cache_size=0, original_source=None,
+                 source_map=False, compact=False, strip_docstrings=False,
+                 profile=None,
                  # constants
-                 len=len, isinstance=isinstance, callable=callable):
-        self.result = []
+                 len=len, isinstance=isinstance, callable=callable, id=id,
+                 sum=sum, map=map):
+        self.result = SourceBuffer(indent_with)
         self.indent_with = indent_with
         self.add_line_information = add_line_information
+        self.compact = compact
+        self.strip_docstrings = strip_docstrings
+        self.profile = profile
         self.indentation = 0  # Current indentation level
         self.new_lines = 0  # Number of lines to insert before next code
-        self.colinfo = 0, 0  # index in result of string containing linefeed, and
-                             # position of last linefeed in that string
         AST = ast.AST
 
+        self.discard_numeric_delim_for_const = False
+
+        # Literals are cached, as the same strings tend to recur
+        cache = functools.lru_cache(self.literal_cache_size, typed=True)
+        self.docstring_literal = cache(_docstring_literal)
+        self.fstring_literal = cache(_fstring_literal)
+        self.string_literal = cache(repr)
+
+        # Precedence of each node's parent, keyed by id(node)
+        self.precedence = precedence = {}
+        self.set_precedence = precedence_setter(precedence)
+        get_precedence = precedence.get
+        highest = Precedence.highest
+
+        def get__pp(node):
+            value = get_precedence(id(node))
+            if value is None:
+                # Set by the deprecated module-level set_precedence()
+                return getattr(node, '_pp', highest)
+            return value
+
+        self.get__pp = get__pp
+
+        if original_source is not None and not add_line_information:
+            self.visit = self.reuse_source(self.visit, original_source)
+        if subtree_cache_size:
+            self.visit = self.subtree_cache(self.visit, subtree_cache_size)
+        if source_map:
+            self.visit = self.record_spans(self.visit)
+        if profile is not None:
+            self.visit = self.profile_visits(self.visit, profile)
+
         visit = self.visit
         result = self.result
         append = result.append
-
-        self.discard_numeric_delim_for_const = False
+        extend = result.extend
+        linefeeds = result.linefeeds
+        indents = result.indents
+        long_lines = result.long_lines
+        maxline = result.maxline
+        # Compact output is not wrapped, so its lines are not measured
+        measure = not compact
+
+        # Operator nodes that write_operators() can write without
+        # calling visit(), because their visit method is not overridden.
+        cls = type(self)
+        self.inline_operators = set(
+            nodetype for nodetype in (ast.BinOp, ast.BoolOp, ast.UnaryOp)
+            if getattr(cls, 'visit_' + nodetype.__name__) is
+            getattr(SourceGenerator, 'visit_' + nodetype.__name__))
+        # Whether constants_source() may write containers of simple
+        # constants without visiting them.
+        self.inline_constants = all(
+            getattr(cls, name) is getattr(SourceGenerator, name)
+            for name in ('visit_Constant', '_handle_numeric_constant',
+                         '_handle_string_constant'))
+        if source_map or profile is not None:
+            # Visit every operator and constant, so that it is recorded.
+            self.inline_operators = set()
+            self.inline_constants = False
+
+        # The number of characters written to the current line,
+        # and to the lines before it
+        width = done = 0
 
         def write(*params):
             """ self.write is a closure for performance (to reduce the number
                 of attribute lookups).
             """
+            nonlocal width, done
             for item in params:
                 if isinstance(item, AST):
                     visit(item)
@@ -176,17 +937,65 @@ class SourceGenerator(ExplicitNodeVisitor):
                     item()
                 else:
                     if self.new_lines:
-                        append('\n' * self.new_lines)
-                        self.colinfo = len(result), 0
-                        append(self.indent_with * self.indentation)
+                        if measure and width > maxline and \
+                                '\n' not in result[-1]:
+                            long_lines.append((result.line_start,
+                                               len(result)))
+                        done += width + self.new_lines
+                        append(linefeeds[self.new_lines])
+                        result.line_start = len(result)
+                        indent = indents[self.indentation]
+                        append(indent)
+                        width = len(indent)
                         self.new_lines = 0
                     if item:
                         append(item)
+                        width += len(item)
+
+        def write_fragments(fragments):
+            """Append `fragments` to the current line, without visiting
+               them or writing pending linefeeds, and add them to its
+               width.
+            """
+            nonlocal width
+            extend(fragments)
+            width += sum(map(len, fragments))
+
+        def chars_written():
+            """Return the number of characters written so far."""
+            return done + width
+
+        def truncate(index, written):
+            """Remove the fragments of the current line from `index` on,
+               which were written after the first `written` characters.
+            """
+            nonlocal width
+            del result[index:]
+            width = written - done
+
+        def clear_result():
+            """Discard the output, and the width of its last line."""
+            nonlocal width, done
+            result.clear()
+            width = done = 0
 
         self.write = write
+        self.write_fragments = write_fragments
+        self.chars_written = chars_written
+        self.truncate = truncate
+        self.clear_result = clear_result
+
+    def reset(self):
+        """Discard the output and the state of the previous conversion,
+        so that the generator can be used again.
+        """
+        self.clear_result()
+        self.precedence.clear()
+        self.indentation = 0
+        self.new_lines = 0
+        self.discard_numeric_delim_for_const = False
 
-    def __getattr__(self, name, defaults=dict(keywords=(),
-                    _pp=Precedence.highest).get):
+    def __getattr__(self, name, defaults=dict(keywords=()).get):
         """ Get an attribute of the node.
             like dict.get (returns None if doesn't exist)
         """
@@ -202,9 +1011,274 @@ class SourceGenerator(ExplicitNodeVisitor):
         setattr(self, name, getter)
         return getter
 
+    def subtree_cache(self, visit, maxsize,
+                      # Runtime optimization
+                      expr=ast.expr, uncached=(ast.Name, ast.Constant),
+                      isinstance=isinstance, type=type, id=id, len=len,
+                      tuple=tuple):
+        """Wrap `visit` with a bounded LRU cache of the fragments
+        written for each expression.
+
+        Code generators often reuse the same node objects many times
+        in a tree (annotations, decorators, dotted names, constant
+        tables...), so expressions are cached by identity, together
+        with the parent precedence and the other state that affects
+        their output.  Names and constants are cheaper to write than
+        to look up, so they are not cached.
+
+        Most expressions only occur once, so an expression's fragments
+        are only copied into the cache the second time it is visited.
+        The least recently used expressions are dropped to keep the
+        number of fragments held under `maxsize`.
+        """
+        cache = collections.OrderedDict()
+        get = cache.get
+        move_to_end = cache.move_to_end
+        seen = set()
+        result = self.result
+        get_pp = self.get__pp
+        currsize = 0
+
+        def cached_visit(node):
+            nonlocal currsize
+            if not isinstance(node, expr) or type(node) in uncached:
+                return visit(node)
+            key = id(node), get_pp(node), self.discard_numeric_delim_for_const
+            # Flush any pending linefeeds first, so they are not cached.
+            self.write('')
+            fragments = get(key)
+            if fragments is not None:
+                move_to_end(key)
+                self.write_fragments(fragments)
+                return
+            if key not in seen:
+                if len(seen) >= maxsize:
+                    seen.clear()
+                seen.add(key)
+                return visit(node)
+            start = len(result)
+            visit(node)
+            size = len(result) - start
+            if size > maxsize:
+                return
+            cache[key] = tuple(result[start:])
+            currsize += size
+            while currsize > maxsize:
+                currsize -= len(cache.popitem(last=False)[1])
+
+        return cached_visit
+
+    def reuse_source(self, visit, source,
+                     # Runtime optimization
+                     stmt=ast.stmt, isinstance=isinstance, getattr=getattr,
+                     functions=(ast.FunctionDef, ast.AsyncFunctionDef),
+                     definitions=(ast.FunctionDef, ast.AsyncFunctionDef,
+                                  ast.ClassDef),
+                     blocks=('body', 'orelse', 'finalbody', 'handlers',
+                             'cases')):
+        """Wrap `visit` so that statements which are unchanged since
+        they were parsed from `source` are written by copying their
+        original text.
+
+        A statement is copied if it is identical to the statement that
+        was parsed from `source` at its position, and if its
+        original text starts at the current indentation.  Anything else
+        is generated as usual, so a modified statement is regenerated
+        while its unmodified children are still copied.  Expressions
+        are always generated, as their original text may depend on
+        parentheses or line continuations outside of their position
+        range.
+        """
+        lines = source.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+        AST = ast.AST
+        originals = []  # Parsed lazily
+
+        def get_original(key):
+            if not originals:
+                index = {}
+                try:
+                    tree = ast.parse(source)
+                except (SyntaxError, ValueError):
+                    pass
+                else:
+                    work = tree.body[:]
+                    while work:
+                        item = work.pop()
+                        if isinstance(item, stmt):
+                            index[position(item)] = item
+                        for name in blocks:
+                            work.extend(getattr(item, name, ()))
+                originals.append(index)
+            return originals[0].get(key)
+
+        def position(node):
+            return (getattr(node, 'lineno', None),
+                    getattr(node, 'col_offset', None),
+                    getattr(node, 'end_lineno', None),
+                    getattr(node, 'end_col_offset', None))
+
+        def same_tree(tree1, tree2, type=type, list=list, zip=zip, len=len):
+            """Compare two trees, ignoring their _attributes.  Unlike
+               node_util.fast_compare, values of different types (such
+               as 1 and True) are never equal.
+            """
+            work = [(tree1, tree2)]
+            pop = work.pop
+            append = work.append
+            extend = work.extend
+            while work:
+                n1, n2 = pop()
+                t = type(n1)
+                if t is not type(n2):
+                    return False
+                if t is list:
+                    if len(n1) != len(n2):
+                        return False
+                    extend(zip(n1, n2))
+                elif isinstance(n1, AST):
+                    for name in t._fields:
+                        append((getattr(n1, name, None),
+                                getattr(n2, name, None)))
+                elif n1 != n2:
+                    return False
+            return True
+
+        def to_chars(line, offset):
+            """Convert a UTF-8 byte offset into a character offset."""
+            if line.isascii():
+                return offset
+            return len(line.encode('utf-8')[:offset].decode('utf-8', 'replace'))
+
+        def original_text(node):
+            key = position(node)
+            if None in key:
+                return None
+            original = get_original(key)
+            if original is None:
+                return None
+            lineno, col, end_lineno, end_col = key
+            for decorator in original.decorator_list if \
+                    isinstance(original, definitions) else ():
+                lineno = min(lineno, decorator.lineno)
+            first = lines[lineno - 1]
+            col = to_chars(first, col)
+            if first[:col] != self.indent_with * self.indentation:
+                return None
+            if not same_tree(original, node):
+                return None
+            if lineno == end_lineno:
+                return first[col:to_chars(first, end_col)]
+            last = lines[end_lineno - 1]
+            return '\n'.join([first[col:]] + lines[lineno:end_lineno - 1] +
+                             [last[:to_chars(last, end_col)]])
+
+        def reusing_visit(node):
+            if not isinstance(node, stmt):
+                return visit(node)
+            text = original_text(node)
+            if text is None:
+                return visit(node)
+            # Insert the same blank lines as the visit_* method would.
+            definition = isinstance(node, functions)
+            if definition:
+                self.newline(extra=1 if self.indentation else 2)
+            elif isinstance(node, ast.ClassDef):
+                definition = True
+                self.newline(extra=2)
+            self.newline(node)
+            self.write(text)
+            if definition and not self.indentation:
+                self.newline(extra=2)
+
+        return reusing_visit
+
+    def record_spans(self, visit, array=array.array, len=len,
+                     JoinedStr=ast.JoinedStr, type=type):
+        """Wrap `visit` to record the nodes it visits in `spans`,
+        together with the indices of the first and last fragments
+        written for each of them.
+
+        The fragments written for the parts of an f-string are joined
+        into one, so the nodes inside f-strings are not recorded.
+        """
+        nodes = []
+        first = array('L')
+        last = array('L')
+        self.spans = nodes, first, last
+        result = self.result
+        append = nodes.append
+
+        def recording_visit(node):
+            index = len(nodes)
+            append(node)
+            first.append(len(result))
+            last.append(0)
+            visit(node)
+            last[index] = len(result)
+            if type(node) is JoinedStr:
+                del nodes[index + 1:], first[index + 1:], last[index + 1:]
+
+        return recording_visit
+
+    def profile_visits(self, visit, stats, timer=time.perf_counter,
+                       type=type):
+        """Wrap `visit` to accumulate the number of calls, the time and
+        the number of characters written for each visit method in
+        `stats`.
+
+        The characters are counted by write() as it goes, so each visit
+        only reads the count before and after.
+        """
+        # Time and characters taken by the children of each active visit
+        nested = [[0.0, 0]]
+        active = collections.defaultdict(int)
+
+        def profiling_visit(node):
+            key = 'visit_' + type(node).__name__
+            entry = _profile_entry(stats, key)
+            active[key] += 1
+            written = self.chars_written()
+            nested.append([0.0, 0])
+            start = timer()
+            visit(node)
+            elapsed = timer() - start
+            chars = self.chars_written() - written
+            children_time, children_chars = nested.pop()
+            parent = nested[-1]
+            parent[0] += elapsed
+            parent[1] += chars
+            entry['calls'] += 1
+            entry['time'] += elapsed - children_time
+            entry['chars'] += chars - children_chars
+            active[key] -= 1
+            if not active[key]:
+                # Recursive calls are included in the outermost one
+                entry['cumtime'] += elapsed
+
+        return profiling_visit
+
     def delimit(self, *args):
         return Delimit(self, *args)
 
+    def open_paren(self, node, op=None, discard=False):
+        """Write an opening parenthesis if `node` (or `op`, if given)
+        binds less tightly than the precedence its parent set for it,
+        unless `discard` is true, and return whether it did.  The
+        caller is responsible for writing the closing parenthesis.
+
+        Unlike `delimit`, this decides before anything is written, so
+        no object is created for each node.  Where no parenthesis is
+        written, an empty fragment takes its place, as pretty_source()
+        may break lines there.
+        """
+        write = self.write
+        if not discard and get_op_precedence(op or node) < self.get__pp(node):
+            write(_lparen)
+            return True
+        write('')
+        self.result.append('')
+        return False
+
     def conditional_write(self, *stuff):
         if stuff[-1] is not None:
             self.write(*stuff)
@@ -212,6 +1286,8 @@ class SourceGenerator(ExplicitNodeVisitor):
             return True
 
     def newline(self, node=None, extra=0):
+        if self.compact:
+            extra = 0
         self.new_lines = max(self.new_lines, 1 + extra)
         if node is not None and self.add_line_information:
             self.write('# line: %s' % node.lineno)
@@ -231,15 +1307,15 @@ class SourceGenerator(ExplicitNodeVisitor):
 
         def write_comma(add_first_comma=False):
             if add_first_comma:
-                self.write(', ')
+                self.write(_comma)
             else:
                 if want_comma:
-                    self.write(', ')
+                    self.write(_comma)
                 else:
                     want_comma.append(True)
 
         def loop_args(args, defaults):
-            set_precedence(Precedence.Comma, defaults)
+            self.set_precedence(Precedence.Comma, defaults)
             padding = [None] * (len(args) - len(defaults))
             for arg, default in zip(args, padding + defaults):
                 if arg.type_comment:
@@ -281,40 +1357,83 @@ class SourceGenerator(ExplicitNodeVisitor):
             self.statement(decorator, '@', decorator)
 
     def comma_list(self, items, trailing=False):
-        set_precedence(Precedence.Comma, *items)
-        for idx, item in enumerate(items):
-            self.write(', ' if idx else '', item)
+        constants = self.constants_source(items)
+        if constants is not None:
+            sources, numeric = constants
+            self.write('')  # Process any pending newlines
+            self.write_fragments(_interleave([_comma] + [''] * numeric,
+                                             sources))
+        else:
+            self.set_precedence(Precedence.Comma, *items)
+            for idx, item in enumerate(items):
+                self.write(_comma if idx else '', item)
         self.write(',' if trailing else '')
 
+    def constants_source(self, nodes,
+                         # Runtime optimization
+                         Constant=ast.Constant, numbers=(int, float, bool),
+                         literals=(bytes, type(None)), isfinite=math.isfinite,
+                         get_value=operator.attrgetter('value'),
+                         get_kind=operator.attrgetter('kind'),
+                         type=type, set=set, map=map, list=list, all=all,
+                         any=any, repr=repr):
+        """Data tables are often written as containers with a huge
+        number of constants, so if `nodes` are all constants of the same
+        kind, return the source of each of them, which is computed in
+        bulk rather than by visiting them one by one, and whether they
+        are numbers.  Otherwise, return None.
+
+        Numbers are written after an empty fragment, where
+        visit_Constant() would have decided not to write a parenthesis.
+        """
+        if not nodes or not self.inline_constants:
+            return None
+        nodetypes = set(map(type, nodes))
+        if len(nodetypes) != 1 or Constant not in nodetypes:
+            return None
+        values = list(map(get_value, nodes))
+        types = set(map(type, values))
+        if types.issubset(numbers):
+            if float in types and not all(map(isfinite, values)):
+                return None
+            return list(map(repr, values)), True
+        if types == {str}:
+            if any(map(get_kind, nodes)):
+                return None
+            return list(map(self.string_literal, values)), False
+        if types.issubset(literals):
+            return list(map(repr, values)), False
+        return None
+
     def type_params(self, node):
         if getattr(node, 'type_params', []):  # Python >= 3.12
-            self.write('[')
+            self.write(_lbracket)
             self.comma_list(node.type_params)
-            self.write(']')
+            self.write(_rbracket)
 
     # Statements
 
     def visit_Assign(self, node):
-        set_precedence(node, node.value, *node.targets)
+        self.set_precedence(node, node.value, *node.targets)
         self.newline(node)
         for target in node.targets:
-            self.write(target, ' = ')
+            self.write(target, _assign)
         self.visit(node.value)
         self.add_type_comment(node)
 
     def visit_AugAssign(self, node):
-        set_precedence(node, node.value, node.target)
-        self.statement(node, node.target, get_op_symbol(node.op, ' %s= '),
+        self.set_precedence(node, node.value, node.target)
+        self.statement(node, node.target, _augassign[type(node.op)],
                        node.value)
 
     def visit_AnnAssign(self, node):
-        set_precedence(node, node.target, node.annotation)
-        set_precedence(Precedence.Comma, node.value)
+        self.set_precedence(node, node.target, node.annotation)
+        self.set_precedence(Precedence.Comma, node.value)
         need_parens = isinstance(node.target, ast.Name) and not node.simple
-        begin = '(' if need_parens else ''
-        end = ')' if need_parens else ''
+        begin = _lparen if need_parens else ''
+        end = _rparen if need_parens else ''
         self.statement(node, begin, node.target, end, ': ', node.annotation)
-        self.conditional_write(' = ', node.value)
+        self.conditional_write(_assign, node.value)
 
     def visit_ImportFrom(self, node):
         self.statement(node, 'from ', node.level * '.',
@@ -326,14 +1445,14 @@ class SourceGenerator(ExplicitNodeVisitor):
         self.comma_list(node.names)
 
     def visit_Expr(self, node):
-        set_precedence(node, node.value)
+        self.set_precedence(node, node.value)
         self.statement(node)
         self.generic_visit(node)
 
     def visit_TypeAlias(self, node):
         self.statement(node, 'type ', node.name)
         self.type_params(node)
-        self.write(' = ')
+        self.write(_assign)
         self.visit(node.value)
 
     def visit_TypeVar(self, node):
@@ -354,9 +1473,9 @@ class SourceGenerator(ExplicitNodeVisitor):
         self.decorators(node, 1 if self.indentation else 2)
         self.statement(node, '%sdef %s' % (prefix, node.name))
         self.type_params(node)
-        self.write('(')
+        self.write(_lparen)
         self.visit_arguments(node.args)
-        self.write(')')
+        self.write(_rparen)
         self.conditional_write(' -> ', self.get_returns(node))
         self.write(':')
         self.add_type_comment(node)
@@ -374,10 +1493,10 @@ class SourceGenerator(ExplicitNodeVisitor):
 
         def paren_or_comma():
             if have_args:
-                self.write(', ')
+                self.write(_comma)
             else:
                 have_args.append(True)
-                self.write('(')
+                self.write(_lparen)
 
         self.decorators(node, 2)
         self.statement(node, 'class %s' % node.name)
@@ -388,21 +1507,21 @@ class SourceGenerator(ExplicitNodeVisitor):
         for keyword in self.get_keywords(node):
             self.write(paren_or_comma, keyword.arg or '',
                        '=' if keyword.arg else '**', keyword.value)
-        self.write(have_args and '):' or ':')
+        self.write(_rparen_colon if have_args else ':')
         self.newline()
         self.body(node.body, is_docstring=True)
         if not self.indentation:
             self.newline(extra=2)
 
     def visit_If(self, node):
-        set_precedence(node, node.test)
-        self.statement(node, 'if ', node.test, ':')
+        self.set_precedence(node, node.test)
+        self.statement(node, _if, node.test, ':')
         self.body(node.body)
         while True:
             else_ = node.orelse
             if len(else_) == 1 and isinstance(else_[0], ast.If):
                 node = else_[0]
-                set_precedence(node, node.test)
+                self.set_precedence(node, node.test)
                 self.write(self.newline, 'elif ', node.test, ':')
                 self.body(node.body)
             else:
@@ -410,7 +1529,7 @@ class SourceGenerator(ExplicitNodeVisitor):
                 break
 
     def visit_For(self, node, is_async=False):
-        set_precedence(node, node.target)
+        self.set_precedence(node, node.target)
         prefix = 'async ' if is_async else ''
         self.statement(node, '%sfor ' % prefix,
                        node.target, ' in ', node.iter, ':')
@@ -422,8 +1541,8 @@ class SourceGenerator(ExplicitNodeVisitor):
         self.visit_For(node, is_async=True)
 
     def visit_While(self, node):
-        set_precedence(node, node.test)
-        self.statement(node, 'while ', node.test, ':')
+        self.set_precedence(node, node.test)
+        self.statement(node, _while, node.test, ':')
         self.body_or_else(node)
 
     def visit_With(self, node, is_async=False):
@@ -447,7 +1566,7 @@ class SourceGenerator(ExplicitNodeVisitor):
         self.statement(node, 'pass')
 
     def visit_Delete(self, node):
-        self.statement(node, 'del ')
+        self.statement(node, _del)
         self.comma_list(node.targets)
 
     def visit_Try(self, node):
@@ -480,9 +1599,9 @@ class SourceGenerator(ExplicitNodeVisitor):
         self.body(node.body)
 
     def visit_Assert(self, node):
-        set_precedence(node, node.test, node.msg)
+        self.set_precedence(node, node.test, node.msg)
         self.statement(node, 'assert ', node.test)
-        self.conditional_write(', ', node.msg)
+        self.conditional_write(_comma, node.msg)
 
     def visit_Global(self, node):
         self.statement(node, 'global ', ', '.join(node.names))
@@ -491,8 +1610,8 @@ class SourceGenerator(ExplicitNodeVisitor):
         self.statement(node, 'nonlocal ', ', '.join(node.names))
 
     def visit_Return(self, node):
-        set_precedence(node, node.value)
-        self.statement(node, 'return')
+        self.set_precedence(node, node.value)
+        self.statement(node, _return)
         self.conditional_write(' ', node.value)
 
     def visit_Break(self, node):
@@ -520,8 +1639,9 @@ class SourceGenerator(ExplicitNodeVisitor):
         self.body(node.body)
 
     def visit_MatchSequence(self, node):
-        with self.delimit('[]'):
-            self.comma_list(node.patterns)
+        self.write(_lbracket)
+        self.comma_list(node.patterns)
+        self.write(_rbracket)
 
     def visit_MatchValue(self, node):
         self.write(node.value)
@@ -533,24 +1653,25 @@ class SourceGenerator(ExplicitNodeVisitor):
         self.write('*', node.name or '_')
 
     def visit_MatchMapping(self, node):
-        with self.delimit('{}'):
-            for idx, (key, value) in enumerate(zip(node.keys, node.patterns)):
-                if key:
-                    set_precedence(Precedence.Expr, key)
-                    set_precedence(Precedence.Comma, value)
-                self.write(', ' if idx else '',
-                           key if key else '',
-                           ': ' if key else '**', value)
-            if node.rest:
-                if node.keys:
-                    self.write(', ')
-                self.write('**', node.rest)
+        self.write(_lbrace)
+        for idx, (key, value) in enumerate(zip(node.keys, node.patterns)):
+            if key:
+                self.set_precedence(Precedence.Expr, key)
+                self.set_precedence(Precedence.Comma, value)
+            self.write(_comma if idx else '',
+                       key if key else '',
+                       ': ' if key else '**', value)
+        if node.rest:
+            if node.keys:
+                self.write(_comma)
+            self.write('**', node.rest)
+        self.write(_rbrace)
 
     def visit_MatchAs(self, node):
         if not node.pattern:
             self.write(node.name or '_')
         elif isinstance(node.pattern, ast.MatchAs) and node.pattern.pattern:
-            self.write('(', node.pattern, ')', ' as ', node.name)
+            self.write(_lparen, node.pattern, _rparen, ' as ', node.name)
         else:
             self.write(node.pattern, ' as ', node.name)
 
@@ -562,7 +1683,7 @@ class SourceGenerator(ExplicitNodeVisitor):
                 (isinstance(pattern, ast.MatchAs) and pattern.pattern)
             )
             if needs_parens:
-                self.write(prefix, '(', pattern, ')')
+                self.write(prefix, _lparen, pattern, _rparen)
             else:
                 self.write(prefix, pattern)
 
@@ -572,21 +1693,22 @@ class SourceGenerator(ExplicitNodeVisitor):
 
         def write_comma():
             if want_comma:
-                write(', ')
+                write(_comma)
             else:
                 want_comma.append(True)
 
         self.visit(node.cls)
-        with self.delimit('()'):
-            args = node.patterns
-            for arg in args:
-                write(write_comma, arg)
+        write(_lparen)
+        args = node.patterns
+        for arg in args:
+            write(write_comma, arg)
 
-            kwd_attrs = node.kwd_attrs
-            kwd_patterns = node.kwd_patterns
+        kwd_attrs = node.kwd_attrs
+        kwd_patterns = node.kwd_patterns
 
-            for key, value in zip(kwd_attrs, kwd_patterns):
-                write(write_comma, key, '=', value)
+        for key, value in zip(kwd_attrs, kwd_patterns):
+            write(write_comma, key, '=', value)
+        write(_rparen)
 
     # Expressions
 
@@ -599,7 +1721,7 @@ class SourceGenerator(ExplicitNodeVisitor):
 
         def write_comma():
             if want_comma:
-                write(', ')
+                write(_comma)
             else:
                 want_comma.append(True)
 
@@ -607,20 +1729,20 @@ class SourceGenerator(ExplicitNodeVisitor):
         keywords = node.keywords
         numargs = len(args) + len(keywords)
         p = Precedence.Comma if numargs > 1 else Precedence.call_one_arg
-        set_precedence(p, *args)
+        self.set_precedence(p, *args)
         self.visit(node.func)
-        write('(')
+        write(_lparen)
         for arg in args:
             write(write_comma, arg)
 
-        set_precedence(Precedence.Comma,
+        self.set_precedence(Precedence.Comma,
             *(x.value for x in keywords if x.arg))
         for keyword in keywords:
             # a keyword.arg of None indicates dictionary unpacking
             # (Python >= 3.5)
             arg = keyword.arg or ''
             write(write_comma, arg, '=' if arg else '**', keyword.value)
-        write(')')
+        write(_rparen)
 
     def visit_Name(self, node):
         self.write(node.id)
@@ -629,10 +1751,11 @@ class SourceGenerator(ExplicitNodeVisitor):
         value = node.value
 
         if isinstance(value, (int, float, complex)):
-            with self.delimit(node) as delimiters:
-                if self.discard_numeric_delim_for_const:
-                    delimiters.discard = True
-                self._handle_numeric_constant(value)
+            paren = self.open_paren(
+                node, discard=self.discard_numeric_delim_for_const)
+            self._handle_numeric_constant(value)
+            if paren:
+                self.write(_rparen)
         elif isinstance(value, str):
             self._handle_string_constant(node, node.value)
         elif value is Ellipsis:
@@ -643,50 +1766,97 @@ class SourceGenerator(ExplicitNodeVisitor):
     def visit_JoinedStr(self, node):
         self._handle_string_constant(node, None, is_joined=True)
 
-    _FSTRING_ESCAPE_MAP = {
-        '\n': '\\n', '\t': '\\t', '\r': '\\r', '\0': '\\0',
-        '\a': '\\a', '\b': '\\b', '\f': '\\f', '\v': '\\v',
-    }
-
-    @staticmethod
-    def _escape_fstring_literal(content):
-        escape_map = SourceGenerator._FSTRING_ESCAPE_MAP
-        result_chars = []
-        for c in content:
-            escaped = escape_map.get(c)
-            if escaped:
-                result_chars.append(escaped)
-            elif ord(c) < 32 or ord(c) == 127:
-                result_chars.append(f'\\x{ord(c):02x}')
-            elif 0xD800 <= ord(c) <= 0xDFFF:
-                result_chars.append(f'\\u{ord(c):04x}')
-            else:
-                result_chars.append(c)
-        return ''.join(result_chars)
-
-    def process_fstring_nodes(self, node):
+    def process_fstring_nodes(self, node, literals=None,
+                              # Runtime optimization
+                              isinstance=isinstance, str=str, chr=chr,
+                              FormattedValue=ast.FormattedValue,
+                              Constant=ast.Constant,
+                              braced=(ast.Dict, ast.Set, ast.DictComp,
+                                      ast.SetComp)):
+        """Write the parts of an f-string, without its quotes, to the
+           end of the result.  Everything but the expressions is
+           appended directly, bypassing self.write().  If `literals` is
+           a list, the indices of the literal parts are added to it.
+        """
+        result = self.result
+        append = result.append
+        fstring_literal = self.fstring_literal
         for value in node.values:
-            if isinstance(value, ast.FormattedValue):
+            if isinstance(value, FormattedValue):
+                expression = value.value
                 # Add space after { if expression starts with { (dict/set)
                 # to avoid {{ being interpreted as escaped brace
-                needs_space = isinstance(value.value, (
-                    ast.Dict, ast.Set, ast.DictComp, ast.SetComp,
-                ))
-                self.write('{ ' if needs_space else '{')
-                set_precedence(value, value.value)
-                self.visit(value.value)
+                append('{ ' if isinstance(expression, braced) else '{')
+                self.set_precedence(value, expression)
+                self.visit(expression)
                 if value.conversion != -1:
-                    self.write('!%s' % chr(value.conversion))
+                    append('!' + chr(value.conversion))
                 if value.format_spec is not None:
-                    self.write(':')
-                    self.process_fstring_nodes(value.format_spec)
-                self.write('}')
-            elif isinstance(value, ast.Constant):
-                content = str(value.value)
-                if '\\' in content:
-                    content = content.replace('\\', '\\\\')
-                content = content.replace('{', '{{').replace('}', '}}')
-                self.write(self._escape_fstring_literal(content))
+                    append(':')
+                    self.process_fstring_nodes(value.format_spec, literals)
+                append('}')
+            elif isinstance(value, Constant):
+                if literals is not None:
+                    literals.append(len(result))
+                append(fstring_literal(str(value.value)))
+
+    def fstring(self, node, pep701=sys.version_info >= (3, 12)):
+        """Return the source of a JoinedStr node.
+
+           Its parts are written to the end of the result in a single
+           pass, then joined and removed from it, as pretty_source()
+           must not split an f-string.
+
+           If both kinds of quotes occur in the f-string, it is written
+           with triple quotes.  Since Python 3.12 (PEP 701) expressions
+           may reuse the quotes of their f-string, so instead the quote
+           that occurs less often in the literal parts is used, and
+           escaped where it does occur.
+        """
+        self.write('')  # Process any pending newlines
+        result = self.result
+        index = len(result)
+        written = self.chars_written()
+        literals = [] if pep701 else None
+        self.process_fstring_nodes(node, literals)
+        content = ''.join(result[index:])
+
+        if pep701:
+            if "'" in content and '"' in content:
+                singles = doubles = 0
+                for literal in literals:
+                    singles += result[literal].count("'")
+                    doubles += result[literal].count('"')
+                quote = '"' if singles > doubles else "'"
+                if singles if quote == "'" else doubles:
+                    escaped = '\\' + quote
+                    for literal in literals:
+                        result[literal] = result[literal].replace(quote,
+                                                                  escaped)
+                    content = ''.join(result[index:])
+                self.truncate(index, written)
+                return 'f' + quote + content + quote
+        elif '\n' in content:
+            # Convert actual newlines back to \n escape sequences
+            content = content.replace('\n', '\\n')
+        self.truncate(index, written)
+
+        if "'" not in content:
+            return "f'" + content + "'"
+        if '"' not in content:
+            return 'f"' + content + '"'
+        # Both quote types present — use triple quotes
+        if "'''" not in content:
+            quote = "'''"
+        elif '"""' not in content:
+            quote = '"""'
+        else:
+            quote = '"""'
+            content = content.replace('"""', '\\"\\"\\"')
+        # Handle trailing quote matching delimiter
+        if content[-1] == quote[0]:
+            content = content[:-1] + '\\' + content[-1]
+        return 'f' + quote + content + quote
 
     def body(self, statements, is_docstring=False):
         """Handle body of functions, classes, modules etc."""
@@ -695,8 +1865,11 @@ class SourceGenerator(ExplicitNodeVisitor):
            isinstance(statements[0].value.value, str):
             # Handle docstring
             self.indentation += 1
-            self._handle_docstring(statements[0].value.value)
-            self.write(*statements[1:])  # Handle remaining statements normally
+            if not self.strip_docstrings:
+                self._handle_docstring(statements[0].value.value)
+                self.write(*statements[1:])  # Handle remaining statements normally
+            else:
+                self.write(*statements[1:] or [ast.Pass()])
             self.indentation -= 1
         else:
             # No docstring - handle all statements normally
@@ -706,88 +1879,48 @@ class SourceGenerator(ExplicitNodeVisitor):
 
     def visit_Module(self, node):
         """Handle module nodes, including docstrings."""
-        if node.body and isinstance(node.body[0], ast.Expr) and \
-           isinstance(node.body[0].value, ast.Constant) and \
-           isinstance(node.body[0].value.value, str):
+        for statement in self.iter_statements(node):
+            pass
+
+    def iter_statements(self, node):
+        """Write the body of a module one statement at a time,
+           yielding each top-level statement after it has been
+           written to the result.
+
+           The precedences recorded for the nodes of a statement
+           are not needed once it is written, so they are dropped,
+           and the table only grows with the largest statement.
+        """
+        statements = node.body
+        if statements and isinstance(statements[0], ast.Expr) and \
+           isinstance(statements[0].value, ast.Constant) and \
+           isinstance(statements[0].value.value, str):
             # Module-level docstring
-            docstring = node.body[0].value.value
-            self._handle_docstring(docstring)
-            self.write(*node.body[1:])
-        else:
-            self.write(*node.body)
-
-    _DOCSTRING_ESCAPE_MAP = {
-        '\\': '\\\\',
-        '\0': '\\0',
-        '\a': '\\a',
-        '\b': '\\b',
-        '\f': '\\f',
-        '\r': '\\r',
-        '\v': '\\v',
-    }
+            if not self.strip_docstrings:
+                self._handle_docstring(statements[0].value.value)
+                yield statements[0]
+            statements = statements[1:]
+        visit = self.visit
+        clear_precedence = self.precedence.clear
+        for statement in statements:
+            visit(statement)
+            clear_precedence()
+            yield statement
 
     def _handle_docstring(self, value):
         """Convert raw docstring to regular docstring with proper escaping."""
-        escape_map = self._DOCSTRING_ESCAPE_MAP
-        content = ""
-        for ch in value:
-            escaped = escape_map.get(ch)
-            if escaped:
-                content += escaped
-            elif ord(ch) < 32 and ch not in ('\n', '\t'):
-                content += '\\x{:02x}'.format(ord(ch))
-            elif 0xD800 <= ord(ch) <= 0xDFFF:
-                content += '\\u{:04x}'.format(ord(ch))
-            else:
-                content += ch
-
-        # Choose quote style to avoid issues with trailing quotes
-        if content.endswith('"'):
-            if "'''" not in content:
-                self.write("'''" + content + "'''")
-            else:
-                # Content has ''' and ends with " — escape the trailing "
-                content = content[:-1] + '\\"'
-                self.write('"""' + content + '"""')
-        else:
-            self.write('"""' + content + '"""')
+        self.write(self.docstring_literal(value))
 
     def _handle_string_constant(self, node, value, is_joined=False):
         """Handle string constants and preserve escape sequences."""
         self.write('')  # Process any pending newlines
 
         if is_joined:
-            index = len(self.result)
-            self.process_fstring_nodes(node)
-            fstring_content = ''.join(self.result[index:])
-            del self.result[index:]
-
-            # Convert actual newlines back to \n escape sequences
-            fstring_content = fstring_content.replace('\n', '\\n')
-
-            has_single = "'" in fstring_content
-            has_double = '"' in fstring_content
-            if has_single and has_double:
-                # Both quote types present — use triple quotes
-                if "'''" not in fstring_content:
-                    quote = "'''"
-                elif '"""' not in fstring_content:
-                    quote = '"""'
-                else:
-                    quote = '"""'
-                    fstring_content = fstring_content.replace('"""', '\\"\\"\\"')
-                # Handle trailing quote matching delimiter
-                if fstring_content and fstring_content[-1] == quote[0]:
-                    fstring_content = fstring_content[:-1] + '\\' + fstring_content[-1]
-                self.write('f' + quote + fstring_content + quote)
-            elif has_single:
-                self.write('f"' + fstring_content + '"')
-            else:
-                self.write("f'" + fstring_content + "'")
+            self.write(self.fstring(node))
         else:
             # Regular strings
             if value is not None:
-                string_repr = repr(value)
+                string_repr = self.string_literal(value)
                 # If we have a kind (like 'u' for unicode), prepend it
                 kind = getattr(node, 'kind', None)
                 if kind:
@@ -832,22 +1965,29 @@ class SourceGenerator(ExplicitNodeVisitor):
         self.write(s)
 
     def visit_Tuple(self, node):
-        with self.delimit(node) as delimiters:
-            # Two things are special about tuples:
-            #   1) We cannot discard the enclosing parentheses if empty
-            #   2) We need the trailing comma if only one item
-            elts = node.elts
-            delimiters.discard = delimiters.discard and elts
-            self.comma_list(elts, len(elts) == 1)
+        # Two things are special about tuples:
+        #   1) We cannot discard the enclosing parentheses if empty
+        #   2) We need the trailing comma if only one item
+        elts = node.elts
+        if elts:
+            paren = self.open_paren(node)
+        else:
+            paren = True
+            self.write(_lparen)
+        self.comma_list(elts, len(elts) == 1)
+        if paren:
+            self.write(_rparen)
 
     def visit_List(self, node):
-        with self.delimit('[]'):
-            self.comma_list(node.elts)
+        self.write(_lbracket)
+        self.comma_list(node.elts)
+        self.write(_rbracket)
 
     def visit_Set(self, node):
         if node.elts:
-            with self.delimit('{}'):
-                self.comma_list(node.elts)
+            self.write(_lbrace)
+            self.comma_list(node.elts)
+            self.write(_rbrace)
         else:
             # If we tried to use "{}" to represent an empty set, it would be
             # interpreted as an empty dictionary. We can't use "set()" either
@@ -855,64 +1995,132 @@ class SourceGenerator(ExplicitNodeVisitor):
             self.write('{1}.__class__()')
 
     def visit_Dict(self, node):
-        with self.delimit('{}'):
-            for idx, (key, value) in enumerate(zip(node.keys, node.values)):
-                if key:
-                    set_precedence(Precedence.Comma, key)
-                    set_precedence(Precedence.Comma, value)
-                self.write(', ' if idx else '',
-                           key if key else '',
-                           ': ' if key else '**', value)
+        self.write(_lbrace)
+        keys = self.constants_source(node.keys)
+        values = keys and self.constants_source(node.values)
+        if values is not None:
+            self.write_fragments(_interleave(
+                [_comma] + [''] * keys[1], keys[0],
+                [': '] + [''] * values[1], values[0]))
+            self.write(_rbrace)
+            return
+        for idx, (key, value) in enumerate(zip(node.keys, node.values)):
+            if key:
+                self.set_precedence(Precedence.Comma, key)
+                self.set_precedence(Precedence.Comma, value)
+            self.write(_comma if idx else '',
+                       key if key else '',
+                       ': ' if key else '**', value)
+        self.write(_rbrace)
 
     def visit_BinOp(self, node):
-        op, left, right = node.op, node.left, node.right
-        with self.delimit(node, op) as delimiters:
-            ispow = isinstance(op, ast.Pow)
-            p = delimiters.p
-            set_precedence((Precedence.Pow + 1) if ispow else p, left)
-            set_precedence(Precedence.PowRHS if ispow else (p + 1), right)
-            self.write(left, get_op_symbol(op, ' %s '), right)
+        self.write_operators(node)
 
     def visit_BoolOp(self, node):
-        with self.delimit(node, node.op) as delimiters:
-            op = get_op_symbol(node.op, ' %s ')
-            set_precedence(delimiters.p + 1, *node.values)
-            for idx, value in enumerate(node.values):
-                self.write(idx and op or '', value)
+        self.write_operators(node)
 
     def visit_Compare(self, node):
-        with self.delimit(node, node.ops[0]) as delimiters:
-            if self.discard_numeric_delim_for_const:
-                delimiters.discard = True
-            set_precedence(delimiters.p + 1, node.left, *node.comparators)
-            self.visit(node.left)
-            for op, right in zip(node.ops, node.comparators):
-                self.write(get_op_symbol(op, ' %s '), right)
+        op = node.ops[0]
+        paren = self.open_paren(
+            node, op, discard=self.discard_numeric_delim_for_const)
+        self.set_precedence(get_op_precedence(op) + 1,
+                            node.left, *node.comparators)
+        self.visit(node.left)
+        for op, right in zip(node.ops, node.comparators):
+            self.write(get_op_symbol(op, ' %s '), right)
+        if paren:
+            self.write(_rparen)
 
     # assignment expressions; new for Python 3.8
     def visit_NamedExpr(self, node):
-        with self.delimit(node) as delimiters:
-            p = delimiters.p
-            set_precedence(p, node.target)
-            set_precedence(p + 1, node.value)
-            # Python is picky about delimiters for assignment
-            # expressions: it requires at least one pair in any
-            # statement that uses an assignment expression, even
-            # when not necessary according to the precedence
-            # rules. We address this with the kludge of forcing a
-            # pair of parentheses around every assignment
-            # expression.
-            delimiters.discard = False
-            self.write(node.target, ' := ', node.value)
+        p = get_op_precedence(node)
+        self.set_precedence(p, node.target)
+        self.set_precedence(p + 1, node.value)
+        # Python is picky about delimiters for assignment
+        # expressions: it requires at least one pair in any
+        # statement that uses an assignment expression, even
+        # when not necessary according to the precedence
+        # rules. We address this with the kludge of forcing a
+        # pair of parentheses around every assignment
+        # expression.
+        self.write(_lparen, node.target, ' := ', node.value, _rparen)
 
     def visit_UnaryOp(self, node):
-        with self.delimit(node, node.op) as delimiters:
-            set_precedence(delimiters.p, node.operand)
-            sym = get_op_symbol(node.op)
-            self.write(sym, ' ' if sym.isalpha() else '', node.operand)
+        self.write_operators(node)
+
+    def write_operators(self, node,
+                        # Runtime optimization
+                        BinOp=ast.BinOp, BoolOp=ast.BoolOp, Pow=ast.Pow,
+                        type=type, str=str, reversed=reversed):
+        """Write a tree of BinOp, BoolOp and UnaryOp nodes.
+
+        Generated code can chain thousands of operators together, which
+        is far too deep to recurse through visit() for each of them, so
+        the tree is walked with an explicit stack instead.  Other nodes
+        are visited normally, as are operators whose visit method has
+        been overridden by a subclass.
+
+        Closing parentheses are represented on the stack by None.
+        """
+        write = self.write
+        write_fragments = self.write_fragments
+        closing = [_rparen]
+        result = self.result
+        get_pp = self.get__pp
+        set_precedence = self.set_precedence
+        visit = self.visit
+        inline = self.inline_operators
+        root = node
+        stack = [node]
+        pop = stack.pop
+        push = stack.append
+        extend = stack.extend
+        while stack:
+            node = pop()
+            cls = type(node)
+            if cls is str:
+                write(node)
+                continue
+            if node is None:
+                write_fragments(closing)
+                continue
+            if cls not in inline and node is not root:
+                visit(node)
+                continue
+            op = node.op
+            p = get_op_precedence(op)
+            if p >= get_pp(node):
+                # Leave an empty fragment where the parenthesis would
+                # be, after any pending linefeeds, like open_paren().
+                write('')
+                result.append('')
+            else:
+                write(_lparen)
+                push(None)
+            if cls is BinOp:
+                left, right = node.left, node.right
+                ispow = type(op) is Pow
+                set_precedence((Precedence.Pow + 1) if ispow else p, left)
+                set_precedence(Precedence.PowRHS if ispow else (p + 1), right)
+                extend((right, get_op_symbol(op, ' %s '), left))
+            elif cls is BoolOp:
+                values = node.values
+                set_precedence(p + 1, *values)
+                sym = get_op_symbol(op, ' %s ')
+                for value in reversed(values[1:]):
+                    extend((value, sym))
+                push(values[0])
+            else:
+                operand = node.operand
+                set_precedence(p, operand)
+                sym = get_op_symbol(op)
+                push(operand)
+                if sym.isalpha():
+                    push(' ')
+                push(sym)
 
     def visit_Subscript(self, node):
-        set_precedence(node, node.slice)
+        self.set_precedence(node, node.slice)
         # A tuple slice with starred elements needs explicit parentheses
         # because a[x, *y] is a SyntaxError (Python < 3.11).
         # In Python 3.11+, PEP 646 made this valid, so only parenthesize
@@ -922,10 +2130,10 @@ class SourceGenerator(ExplicitNodeVisitor):
                 any(isinstance(e, ast.Starred) for e in node.slice.elts)):
             self.write(node.value, '[(', node.slice, ')]')
         else:
-            self.write(node.value, '[', node.slice, ']')
+            self.write(node.value, _lbracket, node.slice, _rbracket)
 
     def visit_Slice(self, node):
-        set_precedence(node, node.lower, node.upper, node.step)
+        self.set_precedence(node, node.lower, node.upper, node.step)
         self.conditional_write(node.lower)
         self.write(':')
         self.conditional_write(node.upper)
@@ -936,52 +2144,64 @@ class SourceGenerator(ExplicitNodeVisitor):
                 self.visit(node.step)
 
     def visit_Yield(self, node):
-        with self.delimit(node):
-            set_precedence(get_op_precedence(node) + 1, node.value)
-            self.write('yield')
-            self.conditional_write(' ', node.value)
+        paren = self.open_paren(node)
+        self.set_precedence(get_op_precedence(node) + 1, node.value)
+        self.write('yield')
+        self.conditional_write(' ', node.value)
+        if paren:
+            self.write(_rparen)
 
     # new for Python 3.3
     def visit_YieldFrom(self, node):
-        with self.delimit(node):
-            self.write('yield from ', node.value)
+        paren = self.open_paren(node)
+        self.write('yield from ', node.value)
+        if paren:
+            self.write(_rparen)
 
     # new for Python 3.5
     def visit_Await(self, node):
-        with self.delimit(node):
-            self.write('await ', node.value)
+        paren = self.open_paren(node)
+        self.write('await ', node.value)
+        if paren:
+            self.write(_rparen)
 
     def visit_Lambda(self, node):
-        with self.delimit(node) as delimiters:
-            set_precedence(delimiters.p, node.body)
-            self.write('lambda ')
-            self.visit_arguments(node.args)
-            self.write(': ', node.body)
+        paren = self.open_paren(node)
+        self.set_precedence(get_op_precedence(node), node.body)
+        self.write('lambda ')
+        self.visit_arguments(node.args)
+        self.write(': ', node.body)
+        if paren:
+            self.write(_rparen)
 
     def visit_ListComp(self, node):
-        with self.delimit('[]'):
-            self.write(node.elt, *node.generators)
+        self.write(_lbracket, node.elt, *node.generators)
+        self.write(_rbracket)
 
     def visit_GeneratorExp(self, node):
-        with self.delimit(node) as delimiters:
-            if delimiters.pp == Precedence.call_one_arg:
-                delimiters.discard = True
-            set_precedence(Precedence.Comma, node.elt)
-            self.write(node.elt, *node.generators)
+        paren = self.open_paren(
+            node, discard=self.get__pp(node) == Precedence.call_one_arg)
+        self.set_precedence(Precedence.Comma, node.elt)
+        self.write(node.elt, *node.generators)
+        if paren:
+            self.write(_rparen)
 
     def visit_SetComp(self, node):
-        with self.delimit('{}'):
-            self.write(node.elt, *node.generators)
+        self.write(_lbrace, node.elt, *node.generators)
+        self.write(_rbrace)
 
     def visit_DictComp(self, node):
-        with self.delimit('{}'):
-            self.write(node.key, ': ', node.value, *node.generators)
+        self.write(_lbrace, node.key, ': ', node.value, *node.generators)
+        self.write(_rbrace)
 
     def visit_IfExp(self, node):
-        with self.delimit(node) as delimiters:
-            set_precedence(delimiters.p + 1, node.body, node.test)
-            set_precedence(delimiters.p, node.orelse)
-            self.write(node.body, ' if ', node.test, ' else ', node.orelse)
+        paren = self.open_paren(node)
+        p = get_op_precedence(node)
+        self.set_precedence(p + 1, node.body, node.test)
+        self.set_precedence(p, node.orelse)
+        self.write(node.body, ' if ', node.test, ' else ', node.orelse)
+        if paren:
+            self.write(_rparen)
 
     def visit_Starred(self, node):
         self.write('*', node.value)
@@ -1000,8 +2220,8 @@ class SourceGenerator(ExplicitNodeVisitor):
         self.conditional_write(' as ', node.asname)
 
     def visit_comprehension(self, node):
-        set_precedence(node, node.iter, *node.ifs)
-        set_precedence(Precedence.comprehension_target, node.target)
+        self.set_precedence(node, node.iter, *node.ifs)
+        self.set_precedence(Precedence.comprehension_target, node.target)
         stmt = ' async for ' if self.get_is_async(node) else ' for '
         self.write(stmt, node.target, ' in ', node.iter)
         for if_ in node.ifs:
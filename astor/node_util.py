@@ -13,7 +13,9 @@ For a whole-tree approach, see the treewalk submodule.
 """
 
 import ast
+import inspect
 import itertools
+import types
 
 try:
     zip_longest = itertools.zip_longest
@@ -130,17 +132,54 @@ class ExplicitNodeVisitor(ast.NodeVisitor):
     """This expands on the ast module's NodeVisitor class
     to remove any implicit visits.
 
+    The visit method for each node type is looked up once per
+    visitor class and cached in a dispatch table.  Every subclass
+    gets its own table, so methods added by a subclass are found.
+    If visit_* methods are added to a class after it has been
+    used, call its clear_dispatch_cache method.  A visit_* method
+    set on an instance is still used in place of its class's.
+
     """
 
+    _dispatch = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._dispatch = {}
+
+    @classmethod
+    def clear_dispatch_cache(cls):
+        """Forget the cached visit methods of this class and of
+        its subclasses, which may have inherited them.
+        """
+        cls._dispatch.clear()
+        for subclass in cls.__subclasses__():
+            subclass.clear_dispatch_cache()
+
     def abort_visit(node):  # XXX: self?
         msg = 'No defined handler for node of type %s'
         raise AttributeError(msg % node.__class__.__name__)
 
-    def visit(self, node, abort=abort_visit):
+    def visit(self, node, abort=abort_visit,
+              # Runtime optimization
+              FunctionType=types.FunctionType):
         """Visit a node."""
-        method = 'visit_' + node.__class__.__name__
-        visitor = getattr(self, method, abort)
-        return visitor(node)
+        nodetype = node.__class__
+        entry = self._dispatch.get(nodetype)
+        if entry is None:
+            cls = type(self)
+            method = 'visit_' + nodetype.__name__
+            if type(inspect.getattr_static(cls, method, None)) is not FunctionType:
+                # Missing, or not a plain method (e.g. a staticmethod),
+                # so leave it to the normal attribute lookup.
+                return getattr(self, method, abort)(node)
+            entry = cls._dispatch[nodetype] = method, getattr(cls, method)
+        method, visitor = entry
+        attributes = self.__dict__
+        if method in attributes:
+            # Set on the instance, which hides the class's method
+            return attributes[method](node)
+        return visitor(self, node)
 
 
 def allow_ast_comparison():
@@ -171,38 +210,47 @@ def allow_ast_comparison():
                 pass
 
 
-def fast_compare(tree1, tree2):
+def fast_compare(tree1, tree2, ignore=('ctx',)):
     """ This is optimized to compare two AST trees for equality.
         It makes several assumptions that are currently true for
         AST trees used by rtrip, and it doesn't examine the _attributes.
+        Fields named in ignore are not compared either.
     """
 
-    geta = ast.AST.__getattribute__
+    getf = getattr
+    AST = ast.AST
+
+    # The fields to compare, per node type (None for non-nodes)
+    fields = {list: None}
 
     work = [(tree1, tree2)]
     pop = work.pop
     extend = work.extend
-    # TypeError in cPython, AttributeError in PyPy
-    exception = TypeError, AttributeError
-    zipl = zip_longest
     type_ = type
     list_ = list
+    len_ = len
     while work:
         n1, n2 = pop()
+        cls = type_(n1)
+        if cls is not type_(n2):
+            return False
         try:
-            f1 = geta(n1, '_fields')
-            f2 = geta(n2, '_fields')
-        except exception:
-            if type_(n1) is list_:
-                extend(zipl(n1, n2))
+            f1 = fields[cls]
+        except KeyError:
+            f1 = None
+            if issubclass(cls, AST):
+                f1 = [x for x in cls._fields if x not in ignore]
+            fields[cls] = f1
+        if f1 is None:
+            if cls is list_:
+                if len_(n1) != len_(n2):
+                    return False
+                extend(zip(n1, n2))
                 continue
             if n1 == n2:
                 continue
             return False
-        else:
-            f1 = [x for x in f1 if x != 'ctx']
-            if f1 != [x for x in f2 if x != 'ctx']:
-                return False
-            extend((geta(n1, fname), geta(n2, fname)) for fname in f1)
+        extend((getf(n1, fname, None), getf(n2, fname, None))
+               for fname in f1)
 
     return True
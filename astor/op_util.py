@@ -92,10 +92,18 @@ precedence_data = dict((getattr(ast, x, None), z) for x, y, z in op_data)
 symbol_data = dict((getattr(ast, x, None), y) for x, y, z in op_data)
 
 
-def get_op_symbol(obj, fmt='%s', symbol_data=symbol_data, type=type):
+def get_op_symbol(obj, fmt='%s', symbol_data=symbol_data, type=type,
+                  symbols={}, default_data=symbol_data):
     """Given an AST node object, returns a string containing the symbol.
     """
-    return fmt % symbol_data[type(obj)]
+    if symbol_data is not default_data:
+        return fmt % symbol_data[type(obj)]
+    # The formatted symbols are cached, so each is only created once.
+    key = type(obj), fmt
+    symbol = symbols.get(key)
+    if symbol is None:
+        symbol = symbols[key] = fmt % symbol_data[key[0]]
+    return symbol
 
 
 def get_op_precedence(obj, precedence_data=precedence_data, type=type):
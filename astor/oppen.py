@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+Part of the astor library for Python AST manipulation.
+
+License: 3-clause BSD
+
+An alternative engine for pretty_source, based on the
+pretty-printing algorithm in Derek C. Oppen, "Prettyprinting",
+ACM TOPLAS 2(4), 1980.
+
+Each bracketed group of a long line becomes a block that is either
+written on one line, or broken after its opening bracket and before
+its closing bracket, with its contents indented.  Inside a block,
+the items are filled onto each line for as long as they fit.  The
+printer decides where to break in a single pass over the line, and
+never looks further ahead than the space left on the current line,
+so time is linear in the length of the line and memory is bounded
+by the line width.
+
+Pass it to to_source to use it instead of the default engine::
+
+    to_source(node, pretty_source=astor.oppen.pretty_source)
+
+or, for other settings::
+
+    to_source(node, pretty_source=functools.partial(
+        astor.oppen.pretty_source, maxline=99, indent=2))
+"""
+
+import collections
+import functools
+
+from .source_repr import (split_lines, add_parens, fragment_kinds,
+                          OPENING, CLOSING, SEPARATOR)
+
+
+BEGIN, END, BREAK, TEXT = range(4)
+
+# Ways of breaking a block
+FITS, CONSISTENT, INCONSISTENT = range(3)
+
+INFINITY = float('inf')
+
+
+class Printer(object):
+    """Oppen's printer, writing to the list `result`.
+
+    The stream is described by calling `begin` and `end` around
+    blocks, `text` for strings, and `brk` for places where a line may
+    be broken.  If a block does not fit in the space left on the line,
+    a consistent block breaks at every one of its breaks, while an
+    inconsistent block only breaks where the text up to its next break
+    would not fit.  A block is indented `offset` columns more than the
+    block that contains it, and a line is continued at the indentation
+    of its block plus the `offset` of the break.  Continuation lines
+    start with `prefix`, followed by spaces.
+
+    Strings and breaks are held back only until it is known whether
+    the block or break before them fits, so the buffer never holds more
+    than about a line's worth of text.  `flush` writes what is left.
+    """
+
+    def __init__(self, result, maxline=79, prefix=''):
+        self.result = result
+        self.maxline = maxline
+        self.prefix = prefix
+        self.space = maxline
+        self.buffer = collections.deque()
+        self.scan_stack = collections.deque()
+        self.print_stack = [(len(prefix), FITS)]
+        self.left_total = self.right_total = 1
+
+    def begin(self, offset=0, consistent=False):
+        if not self.scan_stack:
+            self.left_total = self.right_total = 1
+        entry = [BEGIN, (offset, consistent), -self.right_total]
+        self.buffer.append(entry)
+        self.scan_stack.append(entry)
+
+    def end(self):
+        if not self.scan_stack:
+            self.print_token(END, None, 0)
+        else:
+            entry = [END, None, -1]
+            self.buffer.append(entry)
+            self.scan_stack.append(entry)
+
+    def brk(self, blank=1, offset=0):
+        if not self.scan_stack:
+            self.left_total = self.right_total = 1
+        else:
+            self.check_stack(0)
+        entry = [BREAK, (blank, offset), -self.right_total]
+        self.buffer.append(entry)
+        self.scan_stack.append(entry)
+        self.right_total += blank
+
+    def text(self, string):
+        size = len(string)
+        if not self.scan_stack:
+            self.print_token(TEXT, string, size)
+        else:
+            self.buffer.append([TEXT, string, size])
+            self.right_total += size
+            self.check_stream()
+
+    def flush(self):
+        right_total = self.right_total
+        for entry in self.scan_stack:
+            entry[2] = 1 if entry[0] == END else entry[2] + right_total
+        self.scan_stack.clear()
+        self.advance_left()
+
+    def check_stream(self):
+        """Once the text held back is too long for the line, the
+           oldest block or break waiting for its size cannot fit,
+           so it can be printed.
+        """
+        buffer = self.buffer
+        scan_stack = self.scan_stack
+        while self.right_total - self.left_total > self.space:
+            if scan_stack and scan_stack[0] is buffer[0]:
+                scan_stack.popleft()[2] = INFINITY
+            self.advance_left()
+            if not buffer:
+                break
+
+    def check_stack(self, depth):
+        """Set the sizes of the blocks and breaks that have ended."""
+        scan_stack = self.scan_stack
+        right_total = self.right_total
+        while scan_stack:
+            entry = scan_stack[-1]
+            kind = entry[0]
+            if kind == BEGIN:
+                if not depth:
+                    break
+                scan_stack.pop()[2] += right_total
+                depth -= 1
+            elif kind == END:
+                scan_stack.pop()[2] = 1
+                depth += 1
+            else:
+                scan_stack.pop()[2] += right_total
+                if not depth:
+                    break
+
+    def advance_left(self):
+        buffer = self.buffer
+        while buffer and buffer[0][2] >= 0:
+            kind, value, size = buffer.popleft()
+            self.print_token(kind, value, size)
+            if kind == BREAK:
+                self.left_total += value[0]
+            elif kind == TEXT:
+                self.left_total += size
+
+    def print_token(self, kind, value, size):
+        print_stack = self.print_stack
+        if kind == TEXT:
+            self.space -= size
+            self.result.append(value)
+        elif kind == BREAK:
+            indent, mode = print_stack[-1]
+            blank, offset = value
+            if mode == FITS or (mode == INCONSISTENT and size <= self.space):
+                self.space -= blank
+                self.result.append(' ' * blank)
+            else:
+                self.newline(indent + offset)
+        elif kind == BEGIN:
+            offset, consistent = value
+            indent = print_stack[-1][0] + offset
+            if size > self.space:
+                print_stack.append((indent, CONSISTENT if consistent
+                                    else INCONSISTENT))
+            else:
+                print_stack.append((indent, FITS))
+        else:
+            print_stack.pop()
+
+    def newline(self, indent):
+        result = self.result
+        if result and result[-1].endswith(' '):
+            result[-1] = result[-1].rstrip(' ')
+        prefix = self.prefix
+        result.append('\n')
+        result.append(prefix + ' ' * (indent - len(prefix)))
+        self.space = self.maxline - indent
+
+
+def rigid_width(line, kinds=None):
+    """Return the length of the longest part of a line
+       that cannot be broken, because it is not inside
+       a pair of brackets that has something between them.
+    """
+    if kinds is None:
+        kinds = fragment_kinds(line)
+    widest = width = depth = 0
+    last = len(line) - 1
+    for index, item in enumerate(line):
+        kind = kinds[index]
+        if kind == OPENING and index < last and \
+                kinds[index + 1] != CLOSING:
+            if not depth:
+                widest = max(widest, width + len(item))
+            depth += 1
+        elif kind == CLOSING and depth and kinds[index - 1] != OPENING:
+            depth -= 1
+            if not depth:
+                width = len(item)
+        elif not depth:
+            width += len(item)
+    return max(widest, width)
+
+
+def wrap_line(line, maxline=79, result=[], indent=4):
+    """Wrap a line that is too long, appending the wrapped
+       line to result.
+
+       Lines are only broken inside brackets, after an opening
+       bracket, before a closing bracket, and after commas and
+       operators.  If the parts of the line outside brackets are
+       too long, parentheses are added where possible, as in
+       the default engine.
+    """
+    indentation = line[0]
+    if indentation and not indentation.strip():
+        line.pop(0)
+    else:
+        indentation = ''
+    if any(item.lstrip().startswith('#') for item in line):
+        # Nothing may follow a comment on its line
+        result.append(indentation)
+        result.extend(line)
+        return result
+    kinds = fragment_kinds(line)
+    if rigid_width(line, kinds) > maxline - len(indentation):
+        line = add_parens(line, maxline, len(indentation))
+        kinds = fragment_kinds(line)
+
+    printer = Printer(result, maxline, indentation)
+    begin, end, brk, text = (printer.begin, printer.end,
+                             printer.brk, printer.text)
+    begin()
+    text(indentation)
+    depth = 0
+    last = len(line) - 1
+    for index, item in enumerate(line):
+        kind = kinds[index]
+        if kind == OPENING and index < last and \
+                kinds[index + 1] != CLOSING:
+            text(item)
+            begin(indent, True)
+            brk(0)
+            begin()
+            depth += 1
+        elif kind == CLOSING and depth and kinds[index - 1] != OPENING:
+            end()
+            brk(0, -indent)
+            text(item)
+            end()
+            depth -= 1
+        elif depth and (kind == SEPARATOR or len(item) > 1 and
+                        item[0] == item[-1] == ' ' and item.strip()):
+            # A comma, or an operator or keyword between two spaces
+            text(item[:-1])
+            brk()
+        else:
+            text(item)
+    end()
+    printer.flush()
+    return result
+
+
+def pretty_source(source, maxline=79, indent=4):
+    """Join the fragments written by the source generator,
+       wrapping the lines that are longer than maxline.
+       Continuation lines are indented by indent spaces
+       for each level of brackets that is broken.
+    """
+    wrap = functools.partial(wrap_line, indent=indent)
+    return ''.join(split_lines(source, maxline, 1 << 12, wrap))
@@ -14,7 +14,7 @@ import ast
 import shutil
 import logging
 
-from astor.code_gen import to_source
+from astor.code_gen import to_source, dump_source
 from astor.file_util import code_to_ast
 from astor.node_util import (allow_ast_comparison, dump_tree,
                              strip_tree, fast_compare)
@@ -73,26 +73,39 @@ def convert(srctree, dsttree=dsttree, readonly=False, dumpall=False,
             badfiles.add(srcfname)
             continue
 
-        try:
-            dsttxt = to_source(srcast)
-        except Exception:
-            if not ignore_exceptions:
-                raise
-            dsttxt = ''
-
-        if not readonly:
-            dstfname = os.path.join(dstpath, fname)
+        if readonly:
             try:
-                with open(dstfname, 'wb') as f:
-                    f.write(dsttxt.encode('utf-8'))
-            except UnicodeEncodeError:
-                badfiles.add(dstfname)
+                dsttxt = to_source(srcast)
+            except Exception:
+                if not ignore_exceptions:
+                    raise
+                dsttxt = ''
+        else:
+            # Stream the source straight into the file; it is only
+            # read back in if it needs to be shown.
+            dsttxt = None
+            dstfname = os.path.join(dstpath, fname)
+            with open(dstfname, 'wb') as f:
+                try:
+                    dump_source(srcast, f)
+                except UnicodeEncodeError:
+                    badfiles.add(dstfname)
+                    f.seek(0)
+                    f.truncate()
+                except Exception:
+                    if not ignore_exceptions:
+                        raise
+                    f.seek(0)
+                    f.truncate()
 
         # As a sanity check, make sure that ASTs themselves
         # round-trip OK
         try:
             dstast = ast.parse(dsttxt) if readonly else parse_file(dstfname)
         except (SyntaxError, ValueError) as exc:
+            if dsttxt is None:
+                with open(dstfname, encoding='utf-8') as f:
+                    dsttxt = f.read()
             print()
             print("File", srcfname)
             print(exc)
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Part of the astor library for Python AST manipulation.
+
+License: 3-clause BSD
+
+This module maps spans of the source code written by
+code_gen.SourceGenerator back to the nodes they were
+written for.
+
+"""
+
+import re
+
+from array import array
+from bisect import bisect_left, bisect_right
+
+
+def align_fragments(fragments, source, inserted=frozenset('\n ()')):
+    """Find the fragments written by the source generator in `source`,
+    which is the same fragments after pretty_source() has wrapped them.
+
+    Wrapping may insert linefeeds, indentation and parentheses between
+    the fragments, and may remove a trailing space from a fragment
+    before a linefeed.  Returns two arrays with the offsets in `source`
+    at which each fragment starts and ends.
+    """
+    starts = array('L')
+    ends = array('L')
+    pos = 0
+    for index, fragment in enumerate(fragments):
+        length = len(fragment)
+        while length:
+            if source.startswith(fragment, pos):
+                if fragment[0] == '(':
+                    pos += _inserted_parens(fragments, index, source, pos)
+                break
+            if fragment[-1] == ' ' and \
+                    source.startswith(fragment[:-1] + '\n', pos):
+                length -= 1
+                break
+            if pos >= len(source) or source[pos] not in inserted:
+                raise ValueError('fragment %d (%r) not found in source' %
+                                 (index, fragment))
+            pos += 1
+        starts.append(pos)
+        pos += length
+        ends.append(pos)
+    return starts, ends
+
+
+def _inserted_parens(fragments, index, source, pos,
+                     match_parens=re.compile(r'\(*').match):
+    """Wrapping inserts opening parentheses in front of any that were
+    written by the generator, so return how many of the parentheses
+    starting at `pos` were inserted.
+    """
+    found = match_parens(source, pos).end() - pos
+    written = 0
+    for index in range(index, len(fragments)):
+        fragment = fragments[index]
+        stripped = fragment.lstrip('(')
+        written += len(fragment) - len(stripped)
+        if stripped or written >= found:
+            break
+    return max(0, found - written)
+
+
+class SourceMap(object):
+    """Maps spans of generated source code back to nodes.
+
+    Each entry is a ``(node, (line, col), (end_line, end_col))``
+    tuple, where lines start at 1 and columns are character offsets
+    starting at 0.  The end position is exclusive.  Entries are in the
+    order the nodes were visited, so a node comes before the nodes it
+    contains.
+    """
+
+    def __init__(self, nodes, lines, cols, end_lines, end_cols):
+        self.nodes = nodes
+        self.lines = lines
+        self.cols = cols
+        self.end_lines = end_lines
+        self.end_cols = end_cols
+        # The index of the entry that encloses each one, or -1.  The
+        # start positions are sorted, so lookups bisect them and then
+        # only have to follow these links up from the entry found.
+        self.parents = parents = array('l')
+        open_entries = []
+        for index, start in enumerate(zip(lines, cols)):
+            while open_entries and (end_lines[open_entries[-1]],
+                                    end_cols[open_entries[-1]]) <= start:
+                open_entries.pop()
+            parents.append(open_entries[-1] if open_entries else -1)
+            open_entries.append(index)
+
+    @classmethod
+    def from_fragments(cls, fragments, spans, source):
+        """Build a map from the spans recorded by the generator.
+
+        `spans` is a ``(nodes, first, last)`` tuple, where ``first``
+        and ``last`` are arrays of the indices in `fragments` at which
+        each node starts and ends.  `source` is the final source code.
+        Whitespace fragments at either end of a span, such as the
+        linefeeds and indentation that precede a statement, are not
+        included in it.
+        """
+        nodes, first, last = spans
+        starts, ends = align_fragments(fragments, source)
+        line_starts = [0]
+        find = source.find
+        pos = find('\n')
+        while pos >= 0:
+            line_starts.append(pos + 1)
+            pos = find('\n', pos + 1)
+
+        def position(offset):
+            line = bisect_right(line_starts, offset)
+            return line, offset - line_starts[line - 1]
+
+        lines = array('L')
+        cols = array('L')
+        end_lines = array('L')
+        end_cols = array('L')
+        for begin, end in zip(first, last):
+            while begin < end and not fragments[begin].strip():
+                begin += 1
+            while end > begin and not fragments[end - 1].strip():
+                end -= 1
+            if begin < end:
+                line, col = position(starts[begin])
+                end_line, end_col = position(ends[end - 1])
+            else:
+                # Nothing was written for the node
+                line, col = end_line, end_col = position(
+                    starts[begin] if begin < len(starts) else len(source))
+            lines.append(line)
+            cols.append(col)
+            end_lines.append(end_line)
+            end_cols.append(end_col)
+        return cls(list(nodes), lines, cols, end_lines, end_cols)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __getitem__(self, index):
+        return (self.nodes[index], (self.lines[index], self.cols[index]),
+                (self.end_lines[index], self.end_cols[index]))
+
+    def __iter__(self):
+        return map(self.__getitem__, range(len(self.nodes)))
+
+    def nodes_at(self, line, col=None):
+        """Return the nodes whose source contains the given position,
+        outermost first.  If `col` is None, return the nodes whose
+        source includes any part of the line.
+        """
+        lines = self.lines
+        end_lines = self.end_lines
+        end_cols = self.end_cols
+        parents = self.parents
+        first = bisect_left(lines, line)
+        stop = bisect_right(lines, line, first)
+        if col is None:
+            # Nodes starting on an earlier line that reach this one,
+            # then every node that starts on it.
+            index = first - 1
+            following = range(first, stop)
+        else:
+            index = bisect_right(self.cols, col, first, stop) - 1
+            following = ()
+        enclosing = []
+        while index >= 0:
+            if end_lines[index] > line or end_lines[index] == line and (
+                    col is None or end_cols[index] > col):
+                enclosing.append(index)
+            index = parents[index]
+        enclosing.reverse()
+        enclosing.extend(following)
+        return [self.nodes[index] for index in enclosing]
+
+    def node_at(self, line, col=None):
+        """Return the innermost node whose source contains the given
+        position, or None.  If `col` is None, return the outermost node
+        that starts on the line (such as the statement a traceback
+        refers to) if there is one.
+        """
+        if col is None:
+            index = bisect_left(self.lines, line)
+            if index < len(self.lines) and self.lines[index] == line:
+                return self.nodes[index]
+        found = self.nodes_at(line, col)
+        return found[-1] if found else None
@@ -16,19 +16,44 @@ The goals of the initial cut of this engine are:
    for anybody who wants to do a better job. :)
 """
 
+import collections
+import threading
 
-def pretty_source(source):
+
+def pretty_source(source, wrap=None):
     """ Prettify the source.
+
+        Each call caches the wrapping of its own long lines;
+        pass a WrapCache as wrap to share one between calls.
     """
 
-    return ''.join(split_lines(source))
+    return ''.join(split_lines(source, chunksize=1 << 12, wrap=wrap))
 
 
-def split_lines(source, maxline=79):
+def split_lines(source, maxline=79, chunksize=None, wrap=None):
     """Split inputs according to lines.
        If a line is short enough, just yield it.
        Otherwise, fix it.
+
+       If chunksize is given, every time that many strings have
+       been collected, they are joined into one, so the result
+       holds far fewer strings than the source.
+
+       Long lines are fixed by calling wrap (by default,
+       a new WrapCache, which calls wrap_line) with the
+       fragments of the line, maxline and the result
+       list to append the wrapped line to.
+
+       If the source says which of its lines are long (see
+       code_gen.SourceBuffer), only those lines are looked
+       at, and the others are joined as they are.
     """
+    if wrap is None:
+        wrap = WrapCache()
+    long_lines = getattr(source, 'long_lines', None)
+    if long_lines is not None and maxline >= source.maxline:
+        return split_long_lines(source, long_lines, maxline, wrap)
+    chunks = []
     result = []
     extend = result.extend
     append = result.append
@@ -47,11 +72,41 @@ def split_lines(source, maxline=79):
                 if count <= maxline or multiline:
                     extend(line)
                 else:
-                    wrap_line(line, maxline, result)
+                    wrap(line, maxline, result)
                 count = 0
                 multiline = False
                 line = []
+                if chunksize and len(result) >= chunksize:
+                    chunks.append(''.join(result))
+                    del result[:]
             append(item)
+    if chunks:
+        chunks.append(''.join(result))
+        return chunks
+    return result
+
+
+def split_long_lines(source, long_lines, maxline, wrap):
+    """Like split_lines, for a source that lists the (start, end)
+       indices of its lines that are longer than source.maxline,
+       and the index at which its last line starts.
+    """
+    join = ''.join
+    result = []
+    append = result.append
+    extend = result.extend
+    done = 0
+    for start, end in long_lines:
+        append(join(source[done:start]))
+        line = source[start:end]
+        if count(line) > maxline:
+            wrap(line, maxline, result)
+        else:
+            extend(line)
+        done = end
+    line_start = source.line_start
+    append(join(source[done:line_start]))
+    extend(split_lines(source[line_start:], maxline, wrap=wrap))
     return result
 
 
@@ -62,6 +117,11 @@ def count(group, slen=str.__len__):
 def wrap_line(line, maxline=79, result=[], count=count):
     """ We have a line that is too long,
         so we're going to try to wrap it.
+
+        The line is measured and split into groups
+        in a single pass by delimiter_table, and then
+        written out by walking those groups by index,
+        so the time taken is linear in its length.
     """
 
     # Extract the indentation
@@ -75,74 +135,165 @@ def wrap_line(line, maxline=79, result=[], count=count):
     assert indent in (0, lenfirst)
     indentation = line.pop(0) if indent else ''
 
-    # Get splittable/non-splittable groups
+    # Get the bounds of the unsplittable/splittable groups
 
-    dgroups = list(delimiter_groups(line))
-    unsplittable = dgroups[::2]
-    splittable = dgroups[1::2]
+    widths, bounds, widest = delimiter_table(line)
 
     # If the largest non-splittable group won't fit
     # on a line, try to add parentheses to the line.
 
-    if max(count(x) for x in unsplittable) > maxline - indent:
+    if widest > maxline - indent:
+        size = len(line)
         line = add_parens(line, maxline, indent)
-        dgroups = list(delimiter_groups(line))
-        unsplittable = dgroups[::2]
-        splittable = dgroups[1::2]
+        if len(line) != size:
+            widths, bounds, widest = delimiter_table(line)
 
     # Deal with the first (always unsplittable) group, and
     # then set up to deal with the remainder in pairs.
 
-    first = unsplittable[0]
+    end = bounds[1]
     append(indentation)
-    extend(first)
-    if not splittable:
+    extend(line[:end])
+    if len(bounds) == 2:
         return result
-    pos = indent + count(first)
+    pos = indent + widths[end]
     indentation += '    '
     indent += 4
     if indent >= maxline / 2:
         maxline = maxline / 2 + indent
 
-    for sg, nsg in zip(splittable, unsplittable[1:]):
+    for index in range(1, len(bounds) - 1, 2):
+        start, end, stop = bounds[index:index + 3]
 
-        if sg:
+        if start < end:
             # If we already have stuff on the line and even
             # the very first item won't fit, start a new line
-            if pos > indent and pos + len(sg[0]) > maxline:
+            if pos > indent and pos + len(line[start]) > maxline:
                 append('\n')
                 append(indentation)
                 pos = indent
 
             # Dump lines out of the splittable group
-            # until the entire thing fits
-            csg = count(sg)
+            # until the entire thing fits.
+            csg = widths[end] - widths[start]
             while pos + csg > maxline:
-                ready, sg = split_group(sg, pos, maxline)
-                if ready[-1].endswith(' '):
-                    ready[-1] = ready[-1][:-1]
-                extend(ready)
+                split = split_index(line, start, pos, maxline, end)
+                csg -= widths[split] - widths[start]
+                extend(line[start:split - 1])
+                last = line[split - 1]
+                append(last[:-1] if last.endswith(' ') else last)
                 append('\n')
                 append(indentation)
+                start = split
                 pos = indent
-                csg = count(sg)
 
             # Dump the remainder of the splittable group
-            if sg:
-                extend(sg)
+            if start < end:
+                extend(line[start:end])
                 pos += csg
 
         # Dump the unsplittable group, optionally
         # preceded by a linefeed.
-        cnsg = count(nsg)
+        cnsg = widths[stop] - widths[end]
         if pos > indent and pos + cnsg > maxline:
             append('\n')
             append(indentation)
             pos = indent
-        extend(nsg)
+        extend(line[end:stop])
         pos += cnsg
 
 
+CacheInfo = collections.namedtuple('CacheInfo',
+                                   'hits misses maxsize currsize')
+
+
+class WrapCache(object):
+    """ Wrap lines with wrap, remembering how recent lines
+        were wrapped, so that a line that was wrapped before
+        is written out again without working out where to
+        break it.
+
+        Generated code tends to repeat the same long lines,
+        at the same indentation, many times over.  Lines
+        are looked up by their fragments, which include
+        their indentation, and by maxline.  As tokens can
+        wrap differently from plain strings with the same
+        text, an entry is only used if its fragments also
+        have the same types.
+
+        A line is only kept the second time it is wrapped,
+        as most lines are not repeated at all.  The least
+        recently used lines are dropped to keep the number
+        of fragments held, before and after wrapping, under
+        maxsize; a line that would not fit on its own is
+        not kept.
+
+        cache_info() returns the numbers of hits and misses,
+        and maxsize and currsize counted in fragments, like
+        the caches of functools.  The counts are approximate
+        if the cache is shared by threads.
+    """
+
+    def __init__(self, wrap=wrap_line, maxsize=1 << 18):
+        self.wrap = wrap
+        self.maxsize = maxsize
+        self.cache = collections.OrderedDict()
+        self.seen = set()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.currsize = 0
+
+    def __call__(self, line, maxline=79, result=[],
+                 tuple=tuple, type=type, map=map, len=len, hash=hash):
+        key = tuple(line), maxline
+        seen = self.seen
+        digest = hash(key)
+        if digest not in seen:
+            # Only lines that recur are worth keeping
+            self.misses += 1
+            if len(seen) >= self.maxsize:
+                seen.clear()
+            seen.add(digest)
+            self.wrap(line, maxline, result)
+            return result
+        cache = self.cache
+        entry = cache.get(key)
+        if entry is not None and \
+                list(map(type, entry[0])) == list(map(type, line)):
+            with self.lock:
+                self.hits += 1
+                if key in cache:
+                    cache.move_to_end(key)
+            result.extend(entry[1])
+            return result
+        start = len(result)
+        self.wrap(line, maxline, result)
+        wrapped = result[start:]
+        size = len(key[0]) + len(wrapped)
+        with self.lock:
+            self.misses += 1
+            if size > self.maxsize:
+                return result
+            old = cache.pop(key, None)
+            if old is not None:
+                self.currsize -= len(old[0]) + len(old[1])
+            cache[key] = key[0], wrapped
+            self.currsize += size
+            while self.currsize > self.maxsize:
+                line, wrapped = cache.popitem(last=False)[1]
+                self.currsize -= len(line) + len(wrapped)
+        return result
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize,
+                         self.currsize)
+
+    def cache_clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.seen.clear()
+            self.hits = self.misses = self.currsize = 0
+
+
 def split_group(source, pos, maxline):
     """ Split a group into two subgroups.  The
         first will be appended to the current
@@ -150,75 +301,179 @@ def split_group(source, pos, maxline):
 
         Note that the first group must always
         contain at least one item.
+    """
+    index = split_index(source, 0, pos, maxline)
+    return source[:index], source[index:]
+
 
-        The original group may be destroyed.
+def split_index(source, index, pos, maxline, end=None, len=len):
+    """ Return the index in source at which to start
+        a new line, if the line is continued from
+        source[index] at position pos.  At least one
+        item is always left on the current line.
+
+        Only items before end (by default, the end
+        of source) are considered.
     """
-    first = []
-    source.reverse()
-    while source:
-        tok = source.pop()
-        first.append(tok)
-        pos += len(tok)
-        if source:
-            tok = source[-1]
+    if end is None:
+        end = len(source)
+    while index < end:
+        pos += len(source[index])
+        index += 1
+        if index < end:
+            tok = source[index]
             allowed = (maxline + 1) if tok.endswith(' ') else (maxline - 4)
             if pos + len(tok) > allowed:
                 break
+    return index
+
+
+# The kinds of fragment that matter to the wrappers
+TEXT, OPENING, CLOSING, SEPARATOR, ASSIGNMENT, STATEMENT = range(6)
+
+
+class Token(str):
+    """A fragment that tells the wrappers what it is.
+
+       The source generator writes the brackets, the commas
+       between items, the assignment operators and the keywords
+       that start a statement as instances of the subclasses
+       below, so the structure of a line can be read from the
+       kinds of its fragments.  The kind of a token is used
+       even where its text says otherwise: a bracket written
+       as a plain Token is never broken after.  Otherwise, a
+       token is a string like any other.
+    """
+    __slots__ = ()
+    kind = TEXT
+
+
+class Opening(Token):
+    __slots__ = ()
+    kind = OPENING
 
-    source.reverse()
-    return first, source
+
+class Closing(Token):
+    __slots__ = ()
+    kind = CLOSING
+
+
+class Separator(Token):
+    __slots__ = ()
+    kind = SEPARATOR
+
+
+class Assignment(Token):
+    __slots__ = ()
+    kind = ASSIGNMENT
+
+
+class Statement(Token):
+    __slots__ = ()
+    kind = STATEMENT
 
 
 begin_delim = set('([{')
 end_delim = set(')]}')
 end_delim.add('):')
 
+statements = set(['del ', 'return', 'yield ', 'if ', 'while '])
+
+# Assignment operators
+ops = list('|^&+-*/%@~') + '<< >> // **'.split() + ['']
+ops = set(' %s= ' % x for x in ops)
+
+# Plain strings are matched by their text, so that the
+# output of generators that do not write tokens is
+# wrapped in the same way.
+text_kinds = dict.fromkeys(begin_delim, OPENING)
+text_kinds.update(dict.fromkeys(end_delim, CLOSING))
+text_kinds[', '] = SEPARATOR
+text_kinds.update(dict.fromkeys(ops, ASSIGNMENT))
+text_kinds.update(dict.fromkeys(statements, STATEMENT))
+
+
+def fragment_kind(item, get=text_kinds.get):
+    """Return the kind of a fragment."""
+    if type(item) is str:
+        return get(item, TEXT)
+    return getattr(item, 'kind', TEXT)
+
+
+def fragment_kinds(line, get=text_kinds.get, str=str, type=type):
+    """Return the list of the kinds of the fragments of a line."""
+    return [get(item, TEXT) if type(item) is str else
+            getattr(item, 'kind', TEXT) for item in line]
+
 
-def delimiter_groups(line, begin_delim=begin_delim,
-                     end_delim=end_delim):
+def delimiter_table(line, kinds=text_kinds, str=str, type=type,
+                    getattr=getattr, len=len):
+    """Walk a line once, matching its brackets.
+
+       Returns (widths, bounds, widest): widths[i] is
+       the length of line[:i]; bounds holds the indices
+       at which the alternating groups of
+       delimiter_groups start, followed by len(line);
+       and widest is the length of the longest
+       unsplittable group.  Brackets are found by their
+       kinds, as in fragment_kinds.
+    """
+    widths = [0]
+    bounds = [0]
+    total = 0
+    widest = 0
+    level = 0
+    splittable = False
+    index = 0
+    for item in line:
+        total += len(item)
+        widths.append(total)
+        index += 1
+        if type(item) is not str:
+            kind = getattr(item, 'kind', TEXT)
+        elif item in kinds:
+            kind = kinds[item]
+        else:
+            continue
+        if splittable:
+            if kind == OPENING:
+                level += 1
+            elif kind == CLOSING:
+                if level:
+                    level -= 1
+                else:
+                    # The closing bracket starts an unsplittable group
+                    bounds.append(index - 1)
+                    splittable = False
+        elif kind == OPENING:
+            bounds.append(index)
+            widest = max(widest, total - widths[bounds[-2]])
+            splittable = True
+    if splittable:
+        assert bounds[-1] == index, line[bounds[-1]:]
+    else:
+        bounds.append(index)
+        widest = max(widest, total - widths[bounds[-2]])
+    return widths, bounds, widest
+
+
+def delimiter_groups(line):
     """Split a line into alternating groups.
        The first group cannot have a line feed inserted,
        the next one can, etc.
     """
-    text = []
-    line = iter(line)
-    while True:
-        # First build and yield an unsplittable group
-        for item in line:
-            text.append(item)
-            if item in begin_delim:
-                break
-        if not text:
-            break
-        yield text
-
-        # Now build and yield a splittable group
-        level = 0
-        text = []
-        for item in line:
-            if item in begin_delim:
-                level += 1
-            elif item in end_delim:
-                level -= 1
-                if level < 0:
-                    yield text
-                    text = [item]
-                    break
-            text.append(item)
-        else:
-            assert not text, text
-            break
+    line = list(line)
+    bounds = delimiter_table(line)[1]
+    for start, end in zip(bounds, bounds[1:]):
+        yield line[start:end]
 
 
-statements = set(['del ', 'return', 'yield ', 'if ', 'while '])
-
-
-def add_parens(line, maxline, indent, statements=statements, count=count):
+def add_parens(line, maxline, indent, count=count):
     """Attempt to add parentheses around the line
        in order to make it splittable.
     """
 
-    if line[0] in statements:
+    if fragment_kind(line[0]) == STATEMENT:
         index = 1
         if not line[0].endswith(' '):
             index = 2
@@ -259,19 +514,14 @@ def add_parens(line, maxline, indent, statements=statements, count=count):
     return [item for group in groups for item in group]
 
 
-# Assignment operators
-ops = list('|^&+-*/%@~') + '<< >> // **'.split() + ['']
-ops = set(' %s= ' % x for x in ops)
-
-
-def get_assign_groups(line, ops=ops):
+def get_assign_groups(line):
     """ Split a line into groups by assignment (including
         augmented assignment)
     """
     group = []
-    for item in line:
+    for item, kind in zip(line, fragment_kinds(line)):
         group.append(item)
-        if item in ops:
+        if kind == ASSIGNMENT:
             yield group
             group = []
     yield group
@@ -0,0 +1,78 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Part of the astor library for Python AST manipulation.
+
+License: 3-clause BSD
+
+This module times to_source on a large module with an increasing
+number of threads, and checks that the output is the same as with a
+single thread.
+
+Usage:
+
+    python -m tests.bench_threads [file.py] [max_threads]
+
+Without a file, a module with a few thousand functions is generated.
+Threads only make conversion faster on a free-threaded build of
+Python with more than one CPU; with the GIL, the timings stay flat.
+
+"""
+
+import ast
+import os
+import sys
+import time
+
+import astor
+
+
+def make_module(count=2000):
+    lines = []
+    for index in range(count):
+        lines.append('def function_%d(a, b=%d, *args, **kwargs):' %
+                     (index, index))
+        lines.append('    """Function number %d."""' % index)
+        lines.append('    if a > b:')
+        lines.append('        return [a * i + b for i in range(%d)]' % index)
+        lines.append('    return {"a": a, "b": b, "args": args}')
+        lines.append('')
+    return ast.parse('\n'.join(lines))
+
+
+def best_time(tree, threads, repeat=3):
+    best = None
+    for attempt in range(repeat):
+        start = time.perf_counter()
+        source = astor.to_source(tree, threads=threads)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, source
+
+
+def main(args):
+    if args and args[0].endswith('.py'):
+        tree = astor.parse_file(args.pop(0))
+    else:
+        tree = make_module()
+    max_threads = int(args[0]) if args else os.cpu_count() or 1
+    gil = getattr(sys, '_is_gil_enabled', lambda: True)()
+    print('Python %s, GIL %s, %d CPUs' %
+          (sys.version.split()[0], 'enabled' if gil else 'disabled',
+           os.cpu_count() or 1))
+    expected = astor.to_source(tree)
+    baseline = None
+    threads = 1
+    while threads <= max_threads:
+        elapsed, source = best_time(tree, threads)
+        baseline = baseline or elapsed
+        if source != expected:
+            raise SystemExit('Output differs with %d threads' % threads)
+        print('%3d threads: %7.3f s  speedup %.2fx' %
+              (threads, elapsed, baseline / elapsed))
+        threads *= 2
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
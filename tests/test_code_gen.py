@@ -9,12 +9,18 @@ Copyright (c) 2015 Patrick Maupin
 """
 
 import ast
+import asyncio
+import concurrent.futures
+import functools
+import gzip
+import io
 import math
 import sys
 import textwrap
 import unittest
 
 import astor
+import astor.oppen
 
 
 def canonical(srctxt):
@@ -1331,5 +1337,939 @@ class StdlibRoundtripRegressionTestCase(unittest.TestCase, Comparisons):
         self.assertAstRoundtrips(source)
 
 
+class IterSourceTestCase(unittest.TestCase):
+
+    source = canonical("""
+        \"\"\"Docstring.\"\"\"
+        import os
+        x = 1
+
+
+        @decorator
+        def f(a, b):
+            return a + b
+
+
+        class C:
+            pass
+        y = [aaaaaaaaaaaaaaa, bbbbbbbbbbbbbbbbbb, cccccccccccccccccc, dddddddddddddddd, eeeeeeee]
+    """)
+
+    def test_matches_to_source(self):
+        tree = ast.parse(self.source)
+        expected = astor.to_source(tree)
+        for chunksize in (1, 2, 100):
+            pieces = list(astor.iter_source(tree, chunksize=chunksize))
+            self.assertEqual(''.join(pieces), expected)
+
+    def test_one_statement_per_piece(self):
+        tree = ast.parse(self.source)
+        pieces = list(astor.iter_source(tree))
+        self.assertEqual(len(pieces), len(tree.body))
+        self.assertEqual(pieces[0], '"""Docstring."""\n')
+        self.assertEqual(pieces[3], '@decorator\ndef f(a, b):\n'
+                                    '    return a + b\n\n\n')
+
+    def test_precedence_dropped_per_statement(self):
+        tree = ast.parse(self.source)
+        generator = astor.SourceGenerator(' ' * 4)
+        for statement in generator.iter_statements(tree):
+            self.assertEqual(generator.precedence, {})
+
+    def test_deprecated_set_precedence(self):
+        Precedence = astor.op_util.Precedence
+
+        class Generator(astor.SourceGenerator):
+            # Written before the precedence table existed
+            def visit_Expr(self, node):
+                astor.code_gen.set_precedence(self.value, node.value)
+                self.statement(node, node.value)
+
+        tree = ast.parse('a + b\n')
+        for value, expected in ((Precedence.Comma, 'a + b\n'),
+                                (Precedence.Mult, '(a + b)\n')):
+            Generator.value = value
+            with self.assertWarns(DeprecationWarning):
+                source = astor.to_source(tree,
+                                         source_generator_class=Generator)
+            self.assertEqual(source, expected)
+            self.assertEqual(tree.body[0].value._pp, value)
+        # The generator's own table takes precedence over _pp
+        self.assertEqual(astor.to_source(tree), 'a + b\n')
+
+    def test_expression(self):
+        node = ast.parse('a + b', mode='eval').body
+        self.assertEqual(list(astor.iter_source(node)),
+                         [astor.to_source(node)])
+
+
+class DumpSourceTestCase(unittest.TestCase):
+
+    source = canonical("""
+        def f(a, b):
+            return 'spam \u00e9'
+
+
+        x = [f(i, i) for i in range(10)]
+    """)
+
+    def test_text_file(self):
+        tree = ast.parse(self.source)
+        f = io.StringIO()
+        astor.dump_source(tree, f)
+        self.assertEqual(f.getvalue(), astor.to_source(tree))
+
+    def test_binary_file(self):
+        tree = ast.parse(self.source)
+        f = io.BytesIO()
+        astor.dump_source(tree, f, buffersize=1)
+        self.assertEqual(f.getvalue(), astor.to_source(tree).encode('utf-8'))
+        f = io.BytesIO()
+        astor.dump_source(tree, f, encoding='latin-1')
+        self.assertEqual(f.getvalue(),
+                         astor.to_source(tree).encode('latin-1'))
+
+    def test_gzip_file(self):
+        tree = ast.parse(self.source)
+        f = io.BytesIO()
+        with gzip.GzipFile(fileobj=f, mode='wb') as compressed:
+            astor.dump_source(tree, compressed, buffersize=16)
+        self.assertEqual(gzip.decompress(f.getvalue()),
+                         astor.to_source(tree).encode('utf-8'))
+        f = io.BytesIO()
+        with gzip.open(f, 'wt', encoding='utf-8') as text:
+            astor.dump_source(tree, text)
+        self.assertEqual(gzip.decompress(f.getvalue()),
+                         astor.to_source(tree).encode('utf-8'))
+
+    def test_binary_wrapper(self):
+        # Objects that are not text files are written bytes, whether
+        # they have a mode that is not a string, or none at all.
+        class Sink(object):
+            def __init__(self, mode):
+                if mode is not None:
+                    self.mode = mode
+                self.parts = []
+
+            def write(self, data):
+                self.parts.append(bytes(data))
+
+        tree = ast.parse(self.source)
+        # GzipFile.mode was an integer before Python 3.13
+        for mode in (2, None):
+            sink = Sink(mode)
+            astor.dump_source(tree, sink)
+            self.assertEqual(b''.join(sink.parts),
+                             astor.to_source(tree).encode('utf-8'))
+
+
+class DeepOperatorTestCase(unittest.TestCase):
+
+    depth = sys.getrecursionlimit() * 2
+
+    def test_long_left_associative_chain(self):
+        names = ['x%d' % i for i in range(self.depth)]
+        node = ast.Name(names[0])
+        for name in names[1:]:
+            node = ast.BinOp(node, ast.Add(), ast.Name(name))
+        source = astor.to_source(ast.Assign([ast.Name('y')], node),
+                                 pretty_source=''.join)
+        self.assertEqual(source, 'y = %s\n' % ' + '.join(names))
+
+    def test_deeply_nested_operators(self):
+        node = ast.Name('x')
+        for i in range(self.depth):
+            if i % 3 == 0:
+                node = ast.UnaryOp(ast.USub(), node)
+            elif i % 3 == 1:
+                node = ast.BoolOp(ast.And(), [ast.Name('y'), node])
+            else:
+                node = ast.BinOp(ast.Name('z'), ast.Mult(), node)
+        source = astor.to_source(ast.Expr(node), pretty_source=''.join)
+        self.assertIn('z * (y and -(z * (y and -(z * (y and -(', source)
+        self.assertIn('-(z * (y and -x))', source)
+
+    def test_overridden_visit_method(self):
+        class Generator(astor.SourceGenerator):
+            def visit_BinOp(self, node):
+                self.write('<', node.left, '>')
+
+        node = ast.parse('-(a * 2 + b)').body[0]
+        self.assertEqual(
+            astor.to_source(node, source_generator_class=Generator),
+            '-<<a>>\n')
+
+    def test_parentheses_without_delimit(self):
+        class Generator(astor.SourceGenerator):
+            def delimit(self, *args):
+                raise AssertionError('delimit() should not be used')
+
+        source = canonical("""
+            def f():
+                x = (-(1).real, a if b else c, (await d) ** 2, (yield))
+                y = ((lambda: 1), [i for i in ()], {1: (2, 3)}, (1,), ())
+                return (a := 1) < 2 != (b < 3), sum(i for i in (x, y))
+        """)
+        tree = ast.parse(source)
+        generated = astor.to_source(tree, source_generator_class=Generator)
+        self.assertIn('x = -(1).real, a if b else c, await d ** 2, (yield)',
+                      generated)
+        self.assertEqual(astor.dump_tree(ast.parse(generated)),
+                         astor.dump_tree(tree))
+
+    def test_delimit_in_subclass(self):
+        class Generator(astor.SourceGenerator):
+            def visit_Name(self, node):
+                with self.delimit('<>'):
+                    self.write(node.id)
+
+        node = ast.parse('f(a, b)').body[0]
+        self.assertEqual(
+            astor.to_source(node, source_generator_class=Generator),
+            '<f>(<a>, <b>)\n')
+
+
+class ReadOnlyTreeTestCase(unittest.TestCase):
+
+    source = canonical("""
+        def f(a, b=(1, 2)):
+            return -(a + b) * 2 ** -a if a and not b else [x for x in a[1:]]
+    """)
+
+    def test_tree_is_not_modified(self):
+        tree = ast.parse(self.source)
+        before = [(node, sorted(vars(node))) for node in ast.walk(tree)]
+        astor.to_source(tree)
+        after = [(node, sorted(vars(node))) for node in ast.walk(tree)]
+        self.assertEqual(before, after)
+
+    def test_shared_tree_in_threads(self):
+        tree = ast.parse(self.source)
+        expected = astor.to_source(tree)
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            results = list(executor.map(astor.to_source, [tree] * 50))
+        self.assertEqual(results, [expected] * 50)
+
+
+class ToSourceManyTestCase(unittest.TestCase):
+
+    def test_paths_and_nodes(self):
+        paths = [astor.code_gen.__file__, astor.op_util.__file__]
+        node = ast.parse('x = (1 + 2) * 3')
+        items = paths + [node]
+        expected = [astor.to_source(astor.parse_file(path)) for path in paths]
+        expected.append(astor.to_source(node))
+
+        results = list(astor.to_source_many(items, workers=2))
+        self.assertEqual(results, expected)
+
+        results = list(astor.to_source_many(items, workers=2, ordered=False,
+                                            indent_with='\t'))
+        self.assertEqual(sorted(index for index, source in results), [0, 1, 2])
+        self.assertEqual(dict(results)[2], astor.to_source(node))
+        self.assertIn('\n\tdef ', dict(results)[0])
+
+    def test_executor(self):
+        items = [ast.parse('x = %d' % i) for i in range(5)]
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            results = list(astor.to_source_many(items, executor=executor))
+            self.assertEqual(results, ['x = %d\n' % i for i in range(5)])
+            # The executor is left running for the caller.
+            self.assertEqual(executor.submit(len, 'abc').result(), 3)
+
+
+class SubtreeCacheTestCase(unittest.TestCase):
+
+    def test_shared_nodes(self):
+        annotation = ast.parse('typing.List[a.b.C]', mode='eval').body
+        operand = ast.parse('x + y', mode='eval').body
+        tree = ast.parse(canonical("""
+            def f(a, b):
+                return -(x + y) * (x + y), [x + y]
+        """))
+        function = tree.body[0]
+        function.args.args[0].annotation = annotation
+        function.args.args[1].annotation = annotation
+        function.returns = annotation
+        value = function.body[0].value
+        value.elts[0].left.operand = operand
+        value.elts[0].right = operand
+        value.elts[1].elts[0] = operand
+        expected = astor.to_source(tree)
+        self.assertEqual(expected, canonical("""
+            def f(a: typing.List[a.b.C], b: typing.List[a.b.C]) -> typing.List[a.b.C]:
+                return -(x + y) * (x + y), [x + y]
+        """) + '\n')
+        for size in (1, 2, 100):
+            self.assertEqual(
+                astor.to_source(tree, subtree_cache_size=size), expected)
+
+    def test_cache_admission_and_size(self):
+        class Generator(astor.SourceGenerator):
+            visits = 0
+
+            def visit_Attribute(self, node):
+                Generator.visits += 1
+                astor.SourceGenerator.visit_Attribute(self, node)
+
+        shared = ast.parse('a.b', mode='eval').body
+        tree = ast.parse('f(x, x, x, x)\ng(y)\n')
+        tree.body[0].value.args[:] = [shared] * 4
+        tree.body[1].value.args[:] = [ast.parse('c.d', mode='eval').body]
+        expected = 'f(a.b, a.b, a.b, a.b)\ng(c.d)\n'
+        # An expression is stored the second time it is visited, if
+        # its 3 fragments fit in the cache.
+        for size, visits in ((100, 3), (3, 3), (2, 5)):
+            Generator.visits = 0
+            self.assertEqual(astor.to_source(
+                tree, source_generator_class=Generator,
+                subtree_cache_size=size), expected)
+            self.assertEqual(Generator.visits, visits)
+
+
+class OriginalSourceTestCase(unittest.TestCase):
+
+    source = canonical("""
+        import os
+
+
+        @decorator
+        def f(a,b):   # keep me
+            return {'a':a,
+                    'b':b}
+        class C:
+            def g(self): return 1
+            x=[1,2,
+               3]
+        y = 1; z = 2
+    """)
+
+    def test_unchanged(self):
+        tree = ast.parse(self.source)
+        self.assertEqual(astor.to_source(tree, original_source=self.source),
+                         canonical("""
+            import os
+
+
+            @decorator
+            def f(a,b):   # keep me
+                return {'a':a,
+                        'b':b}
+
+
+            class C:
+                def g(self): return 1
+                x=[1,2,
+                   3]
+
+
+            y = 1; z = 2
+        """).replace('y = 1; z = 2', 'y = 1\nz = 2') + '\n')
+
+    def test_modified(self):
+        tree = ast.parse(self.source)
+        tree.body[2].body[1].value.elts.append(ast.Constant(4))
+        tree.body[3].value = ast.Constant(True)
+        self.assertEqual(astor.to_source(tree, original_source=self.source),
+                         canonical("""
+            import os
+
+
+            @decorator
+            def f(a,b):   # keep me
+                return {'a':a,
+                        'b':b}
+
+
+            class C:
+
+                def g(self): return 1
+                x = [1, 2, 3, 4]
+
+
+            y = True
+            z = 2
+        """) + '\n')
+
+    def test_stale_source(self):
+        tree = ast.parse(self.source)
+        source = self.source.replace('return 1', 'return 2')
+        output = astor.to_source(tree, original_source=source)
+        self.assertIn('return 1', output)
+        self.assertNotIn('return 2', output)
+        self.assertEqual(astor.to_source(tree, original_source='('),
+                         astor.to_source(tree))
+
+
+class SourceMapTestCase(unittest.TestCase):
+
+    def segment(self, source, start, end):
+        lines = source.split('\n')
+        (line, col), (end_line, end_col) = start, end
+        if line == end_line:
+            return lines[line - 1][col:end_col]
+        return '\n'.join([lines[line - 1][col:]] + lines[line:end_line - 1] +
+                         [lines[end_line - 1][:end_col]])
+
+    def test_spans(self):
+        tree = ast.parse(canonical("""
+            def f(a):
+                return some_function_with_a_long_name(argument_number_one, argument_number_two) + (a or b)
+            x = [1, f'{y}']
+        """))
+        source, source_map = astor.to_source(tree, source_map=True)
+        self.assertEqual(source, astor.to_source(tree))
+        self.assertIsInstance(source_map, astor.SourceMap)
+        spans = [(type(node).__name__, self.segment(source, start, end))
+                 for node, start, end in source_map]
+        self.assertEqual(spans[0], ('Module', source.rstrip('\n')))
+        self.assertIn(('Return', canonical("""
+            return some_function_with_a_long_name(argument_number_one,
+                    argument_number_two) + (a or b)""").lstrip()), spans)
+        self.assertIn(('BoolOp', '(a or b)'), spans)
+        self.assertIn(('Name', 'argument_number_two'), spans)
+        self.assertIn(('Assign', "x = [1, f'{y}']"), spans)
+        self.assertIn(('JoinedStr', "f'{y}'"), spans)
+        self.assertNotIn(('Name', 'y'), spans)
+        for node, start, end in source_map:
+            if isinstance(node, ast.Name):
+                self.assertEqual(self.segment(source, start, end), node.id)
+
+    def test_lookup(self):
+        tree = ast.parse('x = 1\nif x:\n    y = x + 1\n')
+        source, source_map = astor.to_source(tree, source_map=True)
+        assign = tree.body[1].body[0]
+        self.assertIs(source_map.node_at(3), assign)
+        self.assertIs(source_map.node_at(3, 8), assign.value.left)
+        self.assertEqual(source_map.nodes_at(3, 8),
+                         [tree, tree.body[1], assign, assign.value,
+                          assign.value.left])
+        self.assertIsNone(source_map.node_at(4))
+        with self.assertRaises(ValueError):
+            list(astor.iter_source(tree, source_map=True))
+
+    def test_lookup_wrapped(self):
+        tree = ast.parse(canonical("""
+            def f(a):
+                return some_function_with_a_long_name(argument_number_one, argument_number_two) + (a or b)
+            x = 1
+        """))
+        source, source_map = astor.to_source(tree, source_map=True)
+        function = tree.body[0]
+        statement = function.body[0]
+        call = statement.value.left
+        self.assertEqual(source_map.nodes_at(3),
+                         [tree, function, statement, statement.value, call,
+                          call.args[1], statement.value.right,
+                          statement.value.right.values[0],
+                          statement.value.right.values[1]])
+        self.assertEqual(source_map.nodes_at(3, 1),
+                         [tree, function, statement, statement.value, call])
+        self.assertEqual(source_map.nodes_at(4), [tree])
+        self.assertEqual(source_map.nodes_at(6), [tree, tree.body[1],
+                                                  tree.body[1].targets[0],
+                                                  tree.body[1].value])
+        self.assertEqual(source_map.nodes_at(6, 100), [])
+        self.assertEqual(source_map.nodes_at(9), [])
+        nodes = source_map.nodes
+        for index, parent in enumerate(source_map.parents):
+            if parent >= 0:
+                self.assertIn(nodes[index], list(ast.walk(nodes[parent])))
+
+    def test_incompatible_pretty_source(self):
+        def pretty_source(fragments):
+            return ''.join(fragments).replace(', ', ',\t')
+        tree = ast.parse('x = [1, 2]\n')
+        with self.assertRaisesRegex(ValueError, 'pretty_source <function'):
+            astor.to_source(tree, source_map=True,
+                            pretty_source=pretty_source)
+
+
+class StringLiteralTestCase(unittest.TestCase):
+
+    value = 'a\\b\x00\x01\x7f\ud800{}\n\t\'"' * 1000
+
+    def test_docstring(self):
+        tree = ast.Module([ast.Expr(ast.Constant(self.value))], [])
+        source = astor.to_source(tree)
+        self.assertEqual(ast.parse(source).body[0].value.value, self.value)
+
+    def test_fstring(self):
+        tree = ast.Expression(ast.JoinedStr([
+            ast.Constant(self.value),
+            ast.FormattedValue(ast.Name('x', ast.Load()), -1, None),
+        ]))
+        source = astor.to_source(tree)
+        self.assertNotIn('\n', source.rstrip('\n'))
+        value = ast.parse(source).body[0].value.values[0].value
+        self.assertEqual(value, self.value)
+
+    def test_cache(self):
+        generator = astor.SourceGenerator(' ' * 4)
+        generator.visit(ast.parse("x = ['a', 'b', 'a', f'{x}a', f'{x}a']"))
+        self.assertEqual(generator.string_literal.cache_info().hits, 1)
+        self.assertEqual(generator.fstring_literal.cache_info().hits, 1)
+
+    @unittest.skipUnless(sys.version_info >= (3, 10), 'match needs 3.10')
+    def test_cache_kept_by_match(self):
+        generator = astor.SourceGenerator(' ' * 4)
+        string_literal = generator.string_literal
+        generator.visit(ast.parse("match x:\n    case 'a':\n        y = 'a'"))
+        self.assertIs(generator.string_literal, string_literal)
+        self.assertEqual(string_literal.cache_info().hits, 1)
+
+
+class FStringTestCase(unittest.TestCase):
+
+    def test_both_quotes(self):
+        tree = ast.parse('''f"""it's "x" {d['k']:>{w}}"""''')
+        if sys.version_info >= (3, 12):
+            expected = '''f'it\\'s "x" {d['k']:>{w}}'\n'''
+        else:
+            expected = "f'''it's \"x\" {d['k']:>{w}}'''\n"
+        self.assertEqual(astor.to_source(tree), expected)
+
+    def test_nested(self):
+        source = '''f"{x!r:{y}} {f'{z}'}"\n'''
+        self.assertEqual(astor.to_source(ast.parse(source)), source)
+
+
+class VerifyTestCase(unittest.TestCase):
+
+    source = canonical("""
+        import os
+
+
+        def f(a, b):
+            return a - b
+
+
+        x = f(1, 2) * 3
+    """)
+
+    class Generator(astor.SourceGenerator):
+        # Writes every name in upper case
+        def visit_Name(self, node):
+            self.write(node.id.upper())
+
+    def test_verify(self):
+        tree = ast.parse(self.source)
+        source = astor.to_source(tree, verify=True)
+        self.assertEqual(source, astor.to_source(tree))
+        self.assertEqual(astor.to_source(tree.body[2].value, verify=True),
+                         '(f(1, 2) * 3)\n')
+        self.assertEqual(''.join(astor.iter_source(tree, chunksize=2,
+                                                   verify=True)), source)
+
+    def test_mismatch(self):
+        tree = ast.parse(self.source)
+        with self.assertRaises(astor.VerificationError) as context:
+            astor.to_source(tree, source_generator_class=self.Generator,
+                            verify=True)
+        self.assertIs(context.exception.node, tree.body[1])
+        self.assertIn('return A - B', context.exception.source)
+        self.assertNotIn('import os', context.exception.source)
+        self.assertRaises(astor.VerificationError, astor.to_source,
+                          tree.body[2].value,
+                          source_generator_class=self.Generator, verify=True)
+
+        # Statements before the one that did not match are still produced
+        pieces = astor.iter_source(tree, source_generator_class=self.Generator,
+                                   verify=True)
+        self.assertEqual(next(pieces), 'import os\n\n\n')
+        self.assertRaises(astor.VerificationError, next, pieces)
+
+    def test_invalid_source(self):
+        tree = ast.parse('a = 1\nb = 2\n')
+        tree.body[1].targets[0] = ast.Constant(2)
+        with self.assertRaises(astor.VerificationError) as context:
+            astor.to_source(tree, verify=True)
+        self.assertIs(context.exception.node, tree.body[1])
+        self.assertIn('not valid Python', str(context.exception))
+
+    def test_unsupported_options(self):
+        tree = ast.parse(self.source)
+        self.assertRaises(ValueError, astor.to_source, tree, verify=True,
+                          source_map=True)
+        self.assertRaises(ValueError, astor.to_source, tree, verify=True,
+                          strip_docstrings=True)
+
+
+class ProfileTestCase(unittest.TestCase):
+
+    def test_profile(self):
+        tree = ast.parse('x = a + (b + c) * f(d)\nprint(x)\n')
+        stats = {}
+        source = astor.to_source(tree, profile=stats)
+        self.assertEqual(source, astor.to_source(tree))
+        self.assertEqual(stats['visit_Module']['calls'], 1)
+        self.assertEqual(stats['visit_BinOp']['calls'], 3)
+        self.assertEqual(stats['visit_Name']['calls'], 8)
+        self.assertEqual(stats['visit_BinOp']['chars'], len(' +  *  + ()'))
+        self.assertEqual(stats['visit_Call']['chars'], len('()()'))
+        self.assertEqual(stats['pretty_source']['calls'], 1)
+        self.assertEqual(stats['pretty_source']['chars'], len(source))
+        for entry in stats.values():
+            self.assertGreaterEqual(entry['cumtime'], entry['time'])
+        self.assertEqual(stats['visit_Module']['cumtime'],
+                         max(entry['cumtime'] for entry in stats.values()
+                             if entry is not stats['pretty_source']))
+
+        # Statistics are accumulated
+        ''.join(astor.iter_source(tree, profile=stats))
+        self.assertEqual(stats['visit_Module']['calls'], 1)
+        self.assertEqual(stats['visit_Name']['calls'], 16)
+        self.assertEqual(stats['pretty_source']['calls'], 3)
+
+    def test_profile_wrap_cache(self):
+        call = 'f(%s)' % ', '.join('argument_%d' % i for i in range(12))
+        tree = ast.parse('\n'.join([call] * 5))
+        # One cache is shared by all the pieces of a conversion
+        for convert in (astor.to_source, astor.iter_source):
+            stats = {}
+            ''.join(convert(tree, profile=stats))
+            entry = stats['pretty_source']
+            self.assertEqual((entry['wrap_hits'], entry['wrap_misses']),
+                             (3, 2))
+        stats = {}
+        astor.to_source(tree, profile=stats,
+                        pretty_source=astor.source_repr.pretty_source)
+        astor.to_source(tree, profile=stats)
+        entry = stats['pretty_source']
+        self.assertEqual((entry['wrap_hits'], entry['wrap_misses']), (6, 4))
+        astor.to_source(tree, profile=stats, pretty_source=''.join)
+        self.assertEqual(entry['calls'], 3)
+        self.assertEqual((entry['wrap_hits'], entry['wrap_misses']), (6, 4))
+
+    def test_profile_chars(self):
+        # Each character is counted once, by the visit that wrote it,
+        # including the expressions of f-strings.
+        tree = ast.parse('x = f"{a}-{b!r:>{w}}" + (c + d)\nprint(x)\n')
+        stats = {}
+        generator = astor.SourceGenerator('    ', profile=stats)
+        generator.visit(tree)
+        self.assertEqual(sum(entry['chars'] for entry in stats.values()),
+                         len(''.join(generator.result)))
+        self.assertEqual(stats['visit_JoinedStr']['chars'],
+                         len('f"{}-{!r:>{}}"'))
+
+
+class SourceBufferTestCase(unittest.TestCase):
+
+    def test_shared_whitespace(self):
+        generator = astor.SourceGenerator('  ')
+        generator.visit(ast.parse(canonical("""
+            def f():
+                if x:
+                    a = 1
+                    b = 2
+        """)))
+        result = generator.result
+        self.assertIsInstance(result, astor.code_gen.SourceBuffer)
+        indents = [item for item in result if item == '    ']
+        self.assertEqual(len(indents), 2)
+        self.assertIs(indents[0], indents[1])
+        self.assertEqual(''.join(result), '\n\n\n' + canonical("""
+            def f():
+              if x:
+                a = 1
+                b = 2
+        """))
+
+    def test_long_lines(self):
+        long_call = 'f(%s)' % ', '.join('argument%d' % i for i in range(10))
+        source = 'x = 1\n%s\nz = 2\n%s\n' % (long_call, long_call)
+        generator = astor.SourceGenerator('    ')
+        generator.visit(ast.parse(source))
+        result = generator.result
+        # The last line is only measured by pretty_source
+        self.assertEqual([''.join(result[start:end])
+                          for start, end in result.long_lines],
+                         [long_call])
+        self.assertEqual(''.join(result[result.line_start:]), long_call)
+        result.append('\n')
+        self.assertEqual(astor.code_gen.pretty_source(result),
+                         astor.code_gen.pretty_source(list(result)))
+
+        head = result.split(result.index('\n', 1) + 1)
+        self.assertEqual(''.join(head), '\nx = 1\n')
+        self.assertEqual(head.long_lines, [])
+        self.assertEqual([''.join(result[start:end])
+                          for start, end in result.long_lines],
+                         [long_call])
+        self.assertEqual(''.join(result[result.line_start:]),
+                         long_call + '\n')
+        result.clear()
+        self.assertEqual((result, result.long_lines, result.line_start),
+                         ([], [], 0))
+
+    def test_long_line_widths(self):
+        # Lines that only become too long through fragments that are
+        # not written one at a time, such as closing parentheses and
+        # constant tables, are still listed.
+        padding = 'x' * 68
+        lines = ['%s = (a + b) * c' % padding[:-2],
+                 '%s = [1, 2, 3]' % padding,
+                 '%s = 1, 2, 3' % padding[:2]]
+        generator = astor.SourceGenerator('    ')
+        generator.visit(ast.parse('\n'.join(lines) + '\ny = 1\n'))
+        result = generator.result
+        self.assertEqual([''.join(result[start:end])
+                          for start, end in result.long_lines],
+                         lines[:2])
+
+
+class ConstantContainerTestCase(unittest.TestCase):
+
+    class Generator(astor.SourceGenerator):
+        # Overriding visit_Constant disables the bulk path
+        def visit_Constant(self, node):
+            astor.SourceGenerator.visit_Constant(self, node)
+
+    def check(self, source):
+        tree = ast.parse(source)
+        generated = astor.to_source(tree)
+        self.assertEqual(generated, astor.to_source(
+            tree, source_generator_class=self.Generator))
+        self.assertEqual(astor.dump_tree(ast.parse(generated)),
+                         astor.dump_tree(tree))
+        return generated
+
+    def test_homogeneous(self):
+        self.check('x = %r' % (list(range(-500, 500)),))
+        self.check('x = %r' % (tuple(i / 7 for i in range(1000)),))
+        self.check('x = %r' % (set('s%d' % i for i in range(1000)),))
+        self.check('x = %r' % ([b'\\x%d' % i for i in range(1000)],))
+        self.check('x = %r' % (dict(('k%d' % i, i) for i in range(1000)),))
+        self.check('x = %r' % ([None, True, False, 0, 1.5] * 100,))
+
+    def test_other_elements(self):
+        self.assertEqual(self.check('x = (1,)'), 'x = 1,\n')
+        self.check("x = [1, 'a', b'b', None]")
+        self.check("x = [u'a', 'b']")
+        self.check("x = [1e1000, 2]")
+        self.check("x = {'a': 1, **b}")
+        self.check("x = {1: 2, 3: c}")
+
+    def test_wrapping(self):
+        source = self.check('x = %r' % (list(range(10000)),))
+        lines = source.splitlines()
+        self.assertGreater(len(lines), len(source) // 80)
+        self.assertLessEqual(max(map(len, lines)), 79)
+
+
+class OppenTestCase(unittest.TestCase):
+
+    source = textwrap.dedent("""\
+        def process(self, request, response, *, timeout=None, retries=3, backoff_factor=0.5, callback=None):
+            value = {'alpha': compute(first_argument, second_argument), 'beta': [item.value for item in collection if item.enabled]}
+            return self.is_nan() and other.is_nan() or self.is_infinite() and other.is_infinite()
+        """)
+
+    def test_wrapping(self):
+        tree = ast.parse(self.source)
+        source = astor.to_source(tree, pretty_source=astor.oppen.pretty_source)
+        self.assertEqual(source, textwrap.dedent("""\
+            def process(
+                self, request, response, *, timeout=None, retries=3, backoff_factor=0.5,
+                callback=None
+            ):
+                value = {
+                    'alpha': compute(first_argument, second_argument),
+                    'beta': [item.value for item in collection if item.enabled]
+                }
+                return (
+                    self.is_nan() and other.is_nan() or self.is_infinite() and
+                    other.is_infinite()
+                )
+            """))
+
+    def test_settings(self):
+        tree = ast.parse(self.source)
+        pretty_source = functools.partial(astor.oppen.pretty_source,
+                                          maxline=40, indent=2)
+        source = astor.to_source(tree, pretty_source=pretty_source)
+        self.assertTrue(all(len(line) <= 40
+                            for line in source.splitlines()))
+        self.assertIn('\n  self, request,', source)
+        self.assertEqual(ast.dump(ast.parse(source)), ast.dump(tree))
+
+    def test_short_lines(self):
+        source = 'def f(a, b):\n    return {a: b}\n'
+        self.assertEqual(astor.to_source(
+            ast.parse(source), pretty_source=astor.oppen.pretty_source),
+            source)
+
+    def test_long_line(self):
+        tree = ast.parse('x = f(%s)\n' % ', '.join(
+            'g(a%d, [b%d])' % (i, i) for i in range(2000)))
+        source = astor.to_source(tree,
+                                 pretty_source=astor.oppen.pretty_source)
+        self.assertTrue(all(len(line) <= 79
+                            for line in source.splitlines()))
+        self.assertEqual(ast.dump(ast.parse(source)), ast.dump(tree))
+
+
+class AsyncTestCase(unittest.TestCase):
+
+    tree = ast.parse(''.join('def f%d(x):\n    return x + %d\n' % (i, i)
+                             for i in range(50)))
+
+    def convert(self, **options):
+        ticks = []
+
+        async def ticker():
+            while True:
+                ticks.append(None)
+                await asyncio.sleep(0)
+
+        async def main():
+            task = asyncio.ensure_future(ticker())
+            await asyncio.sleep(0)
+            source = await astor.ato_source(self.tree, **options)
+            task.cancel()
+            return source
+
+        return asyncio.run(main()), len(ticks)
+
+    def test_same_as_to_source(self):
+        for options in [{}, dict(compact=True), dict(verify=True)]:
+            source, ticks = self.convert(**options)
+            self.assertEqual(source, astor.to_source(self.tree, **options))
+
+    def test_yields_to_loop(self):
+        source, ticks = self.convert(interval=0)
+        self.assertGreaterEqual(ticks, 50)
+        source, ticks = self.convert(interval=60)
+        self.assertEqual(ticks, 1)
+
+
+class ThreadsTestCase(unittest.TestCase):
+
+    source = textwrap.dedent('''\
+        """Docstring."""
+        import os
+        x = 1
+
+
+        def f(a):
+            return a
+
+
+        @decorator
+        class C:
+            pass
+        y = [%s]
+        if x:
+            pass
+        ''') % ', '.join('name%d' % i for i in range(40))
+
+    def test_same_as_sequential(self):
+        tree = ast.parse(self.source)
+        for options in [{}, dict(compact=True), dict(strip_docstrings=True),
+                        dict(add_line_information=True), dict(verify=True)]:
+            expected = astor.to_source(tree, **options)
+            for threads in (2, 3, 100):
+                self.assertEqual(
+                    astor.to_source(tree, threads=threads, **options),
+                    expected)
+
+    def test_verify(self):
+        class Generator(astor.SourceGenerator):
+            def visit_Name(self, node):
+                self.write(node.id.upper())
+
+        tree = ast.parse('a = 1\nb = 2\nc = 3\n')
+        with self.assertRaises(astor.VerificationError) as cm:
+            astor.to_source(tree, threads=2, verify=True,
+                            source_generator_class=Generator)
+        self.assertIs(cm.exception.node, tree.body[0])
+
+    def test_unsupported_options(self):
+        tree = ast.parse('a = 1\nb = 2\n')
+        for options in [dict(source_map=True), dict(profile={})]:
+            with self.assertRaises(ValueError):
+                astor.to_source(tree, threads=2, **options)
+
+
+class ExprToSourceTestCase(unittest.TestCase):
+
+    def test_same_as_to_source(self):
+        for source in ['x', 'a.b(c)', '-(a + b) ** c', 'lambda x: (yield)',
+                       "f'{x!r:>{width}}'", '[%s]' % ', '.join(
+                           'name%d' % i for i in range(40))]:
+            node = ast.parse(source, mode='eval').body
+            self.assertEqual(astor.expr_to_source(node) + '\n',
+                             astor.to_source(node))
+            # A reused generator gives the same result
+            self.assertEqual(astor.expr_to_source(node) + '\n',
+                             astor.to_source(node))
+        node = ast.parse('if x:\n    y = 1\n').body[0]
+        self.assertEqual(astor.expr_to_source(node), 'if x:\n    y = 1')
+
+    def test_reentrant(self):
+        class Generator(astor.SourceGenerator):
+            def visit_Name(self, node):
+                self.write(repr(astor.expr_to_source(
+                    ast.Attribute(ast.Name(node.id), 'x'),
+                    source_generator_class=astor.SourceGenerator)))
+
+        node = ast.parse('a + b', mode='eval').body
+        self.assertEqual(
+            astor.expr_to_source(node, source_generator_class=Generator),
+            "('a.x' + 'b.x')")
+
+    def test_threads(self):
+        nodes = [ast.parse('a%d(b[%d])' % (i, i), mode='eval').body
+                 for i in range(200)]
+        with concurrent.futures.ThreadPoolExecutor(4) as pool:
+            sources = list(pool.map(astor.expr_to_source, nodes))
+        self.assertEqual(sources, ['a%d(b[%d])' % (i, i)
+                                   for i in range(200)])
+
+
+class CompactTestCase(unittest.TestCase):
+
+    source = canonical("""
+        \"\"\"Module.\"\"\"
+        import os, sys
+
+
+        def f(a: int, *args, b=-1, **kw) -> dict:
+            \"\"\"Function.\"\"\"
+            x = {a: b, **kw}
+            x[1:2] += a ** -b if a is not b else not a
+            return lambda y: y | (a := 3) @ b // 2
+
+
+        class C:
+            \"\"\"Class.\"\"\"
+    """)
+
+    def test_compact(self):
+        tree = ast.parse(self.source)
+        source = astor.to_source(tree, indent_with=' ', compact=True)
+        self.assertEqual(source, canonical('''
+            """Module."""
+            import os,sys
+            def f(a:int,*args,b=-1,**kw)->dict:
+             """Function."""
+             x={a:b,**kw}
+             x[1:2]+=a**-b if a is not b else not a
+             return lambda y:y|(a:=3)@b//2
+            class C:
+             """Class."""
+        ''') + '\n')
+        self.assertEqual(''.join(astor.iter_source(tree, indent_with=' ',
+                                                   compact=True)), source)
+
+    def test_strip_docstrings(self):
+        tree = ast.parse(self.source)
+        source = astor.to_source(tree, strip_docstrings=True)
+        self.assertNotIn('"""', source)
+        self.assertIn('class C:\n    pass\n', source)
+        self.assertEqual(astor.to_source(ast.parse(source)), source)
+
+
 if __name__ == '__main__':
     unittest.main()
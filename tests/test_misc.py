@@ -4,8 +4,11 @@ import unittest
 import warnings
 
 import astor
+import astor.oppen
 
-from astor.source_repr import split_lines
+from astor.source_repr import split_lines, delimiter_table, delimiter_groups
+from astor.source_repr import fragment_kinds, Token, WrapCache, wrap_line
+from astor import source_repr
 
 from .support import import_fresh_module
 
@@ -15,6 +18,19 @@ class GetSymbolTestCase(unittest.TestCase):
     def test_get_mat_mult(self):
         self.assertEqual('@', astor.get_op_symbol(ast.MatMult()))
 
+    def test_symbols_are_shared(self):
+        symbol = astor.get_op_symbol(ast.Add(), ' %s= ')
+        self.assertEqual(symbol, ' += ')
+        self.assertIs(astor.get_op_symbol(ast.Add(), ' %s= '), symbol)
+
+    def test_custom_symbol_data(self):
+        symbol_data = dict(astor.op_util.symbol_data)
+        symbol_data[ast.Add] = 'plus'
+        self.assertEqual(astor.get_op_symbol(ast.Add()), '+')
+        self.assertEqual(astor.get_op_symbol(ast.Add(), ' %s ', symbol_data),
+                         ' plus ')
+        self.assertEqual(astor.get_op_symbol(ast.Add(), ' %s '), ' + ')
+
 
 class PublicAPITestCase(unittest.TestCase):
 
@@ -45,6 +61,57 @@ class PublicAPITestCase(unittest.TestCase):
         )
 
 
+class ExplicitNodeVisitorTestCase(unittest.TestCase):
+
+    def test_dispatch_cache_per_subclass(self):
+        class Visitor(astor.ExplicitNodeVisitor):
+            def visit_Name(self, node):
+                return 'Name'
+
+        class SubVisitor(Visitor):
+            def visit_Pass(self, node):
+                return 'Pass'
+
+        name, pass_ = ast.Name('x'), ast.Pass()
+        self.assertEqual(Visitor().visit(name), 'Name')
+        self.assertEqual(SubVisitor().visit(name), 'Name')
+        self.assertEqual(SubVisitor().visit(pass_), 'Pass')
+        with self.assertRaises(AttributeError) as cm:
+            Visitor().visit(pass_)
+        self.assertEqual(str(cm.exception),
+                         'No defined handler for node of type Pass')
+
+        Visitor.visit_Name = lambda self, node: 'new'
+        self.assertEqual(Visitor().visit(name), 'Name')
+        self.assertEqual(SubVisitor().visit(name), 'Name')
+        # Subclasses that inherited the method are cleared too
+        Visitor.clear_dispatch_cache()
+        self.assertEqual(Visitor().visit(name), 'new')
+        self.assertEqual(SubVisitor().visit(name), 'new')
+
+    def test_instance_visit_method(self):
+        class Visitor(astor.ExplicitNodeVisitor):
+            def visit_Name(self, node):
+                return 'Name'
+
+        visitor = Visitor()
+        name = ast.Name('x')
+        self.assertEqual(visitor.visit(name), 'Name')
+        visitor.visit_Name = lambda node: 'instance'
+        self.assertEqual(visitor.visit(name), 'instance')
+        self.assertEqual(Visitor().visit(name), 'Name')
+        del visitor.visit_Name
+        self.assertEqual(visitor.visit(name), 'Name')
+
+    def test_static_visit_method(self):
+        class Visitor(astor.ExplicitNodeVisitor):
+            @staticmethod
+            def visit_Name(node):
+                return node.id
+
+        self.assertEqual(Visitor().visit(ast.Name('x')), 'x')
+
+
 class FastCompareTestCase(unittest.TestCase):
 
     def test_fast_compare(self):
@@ -60,6 +127,112 @@ class FastCompareTestCase(unittest.TestCase):
         check('a = 3', 'a = 5')
         check('a = 3 - (3, 4, 5)', 'a = 3 - (3, 4, 5)')
         check('a = 3 - (3, 4, 5)', 'a = 3 - (3, 4, 6)')
+        check('a = b + c', 'a = b - c')
+        check('a = 1', 'a = 1.0')
+        check('f(a, b)', 'f(a)')
+
+
+class SplitLinesTestCase(unittest.TestCase):
+
+    def test_chunksize(self):
+        source = ['x', ' = ', '1'] + ['\n', '    ', 'y', ' = ', 'x'] * 10
+        source.append('\n')
+        lines = split_lines(source)
+        self.assertEqual(lines, source)
+        chunks = split_lines(source, chunksize=8)
+        self.assertEqual(''.join(chunks), ''.join(source))
+        self.assertLess(len(chunks), len(source) / 4)
+
+    def test_delimiter_table(self):
+        line = ['x', ' = ', 'f', '(', 'a', ', ', 'g', '(', 'b', ')', ')',
+                ' + ', 'y', '[', 'c', ']']
+        widths, bounds, widest = delimiter_table(line)
+        self.assertEqual(widths[-1], len(''.join(line)))
+        self.assertEqual(bounds, [0, 4, 10, 14, 15, 16])
+        self.assertEqual(widest, len('x = f('))
+        self.assertEqual(list(delimiter_groups(iter(line))),
+                         [line[0:4], line[4:10], line[10:14], line[14:15],
+                          line[15:16]])
+
+    def test_fragment_kinds(self):
+        generator = astor.SourceGenerator(' ' * 4)
+        generator.visit(ast.parse('x += f(a, [b])'))
+        line = generator.result[1:]
+        self.assertEqual(''.join(line), 'x += f(a, [b])')
+        kinds = fragment_kinds(line)
+        self.assertEqual(kinds, fragment_kinds(list(map(str, line))))
+        self.assertEqual([kind for kind in kinds if kind],
+                         [source_repr.ASSIGNMENT, source_repr.OPENING,
+                          source_repr.SEPARATOR, source_repr.OPENING,
+                          source_repr.CLOSING, source_repr.CLOSING])
+        self.assertTrue(all(isinstance(item, Token)
+                            for item, kind in zip(line, kinds) if kind))
+
+    def test_token_kind_overrides_text(self):
+        line = ['x', ' = ', 'f', Token('('), 'a', ', ', 'b', Token(')')]
+        self.assertEqual(delimiter_table(line)[1], [0, len(line)])
+        line = ['x', ' = ', 'f', '(', 'a', ', ', 'b', ')']
+        self.assertEqual(delimiter_table(line)[1], [0, 4, 7, 8])
+        line[3], line[7] = source_repr.Opening('<'), source_repr.Closing('>')
+        self.assertEqual(delimiter_table(line)[1], [0, 4, 7, 8])
+        self.assertEqual(astor.oppen.rigid_width(line), len('x = f<'))
+
+    def test_wrap_cache(self):
+        call = 'f(%s)' % ', '.join('argument_%d' % i for i in range(12))
+        tree = ast.parse('def g():\n%s\n' % '\n'.join(['    ' + call] * 5))
+        generator = astor.SourceGenerator(' ' * 4)
+        generator.visit(tree)
+        generator.result.append('\n')
+        wrap = WrapCache()
+        self.assertEqual(''.join(split_lines(generator.result, wrap=wrap)),
+                         ''.join(split_lines(generator.result)))
+        hits, misses, maxsize, currsize = wrap.cache_info()
+        # A line is only kept when it is seen a second time
+        self.assertEqual((hits, misses), (3, 2))
+        self.assertGreater(currsize, 2 * 25)
+
+        # Tokens may not wrap like strings with the same text
+        line = ['    ', 'x', ' = ', 'f', '(', 'a' * 80, ')']
+        tokens = line[:4] + [Token('('), 'a' * 80, Token(')')]
+        outputs = []
+        for line in (line, tokens):
+            expected = []
+            wrap_line(list(line), 79, expected)
+            self.assertEqual(wrap(list(line), 79, []), expected)
+            outputs.append(expected)
+        self.assertNotEqual(outputs[0], outputs[1])
+        self.assertEqual(wrap.cache_info()[:2], (3, 4))
+        wrap.cache_clear()
+        self.assertEqual(wrap.cache_info(), (0, 0, maxsize, 0))
+
+    def test_wrap_cache_bounds(self):
+        lines = [['    ', 'x%d' % i, ' = ', 'f', '(', 'a' * 80, ')']
+                 for i in range(10)]
+        wrap = WrapCache(maxsize=40)
+        for line in lines + lines + lines[-2:]:
+            wrap(list(line), 79, [])
+        hits, misses, maxsize, currsize = wrap.cache_info()
+        self.assertEqual((hits, misses, maxsize), (2, 20, 40))
+        self.assertEqual(len(wrap.cache), 2)
+        self.assertEqual(currsize, sum(len(line) + len(wrapped)
+                                       for line, wrapped
+                                       in wrap.cache.values()))
+        self.assertLessEqual(currsize, maxsize)
+        # A line that does not fit on its own is not kept
+        line = ['    ', 'x', ' = ', 'f', '('] + ['a' * 20, ', '] * 10 + [')']
+        for count in range(3):
+            wrap(list(line), 79, [])
+        self.assertEqual(wrap.cache_info()[:2], (2, 23))
+        self.assertEqual(len(wrap.cache), 2)
+
+    def test_wrap_long_line(self):
+        call = 'x = f(%s)\n' % ', '.join('g(a%d, [b%d])' % (i, i)
+                                      for i in range(2000))
+        tree = ast.parse(call)
+        source = astor.to_source(tree)
+        self.assertTrue(all(len(line) <= 79
+                            for line in source.splitlines()))
+        self.assertEqual(ast.dump(ast.parse(source)), ast.dump(tree))
 
 
 class TreeWalkTestCase(unittest.TestCase):
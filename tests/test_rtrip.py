@@ -7,6 +7,7 @@ Copyright (c) 2017 Patrick Maupin
 """
 
 import os
+import tempfile
 import unittest
 import warnings
 
@@ -26,6 +27,16 @@ class RtripTestCase(unittest.TestCase):
             result = astor.rtrip.convert(srcdir, readonly=True)
         self.assertEqual([], result)
 
+    def test_convert_to_directory(self):
+        srcdir = os.path.dirname(astor.rtrip.__file__)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dstdir = os.path.join(tmpdir, 'rtrip')
+            result = astor.rtrip.convert(srcdir, dstdir)
+            self.assertEqual([], result)
+            with open(os.path.join(dstdir, 'rtrip.py')) as f:
+                self.assertEqual(f.read(), astor.to_source(
+                    astor.parse_file(astor.rtrip.__file__)))
+
 
 if __name__ == '__main__':
     unittest.main()